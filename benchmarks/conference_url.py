@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Micro-benchmark of the conference URL detection (jcalapi.events)
+# Usage: python benchmarks/conference_url.py [-n ROUNDS]
+
+import argparse
+import re
+import timeit
+
+from jcalapi.events import (
+    REGEX_MS_TEAMS_URL,
+    REGEX_ZOOM_URL,
+    guess_conference_location,
+)
+
+TEAMS_INVITE = """
+<html><head><meta http-equiv="Content-Type" content="text/html; charset=utf-8">
+<style>p{margin:0}</style></head><body>
+<div>Hi all, let's sync on the Q3 roadmap.</div>
+<div style="width:100%"><span style="white-space:nowrap;color:#5F5F5F">
+________________________________________________________________________________
+</span></div>
+<div style="margin-bottom:24px"><span style="font-size:24px;color:#252424">
+Microsoft Teams meeting</span></div>
+<div><span style="font-size:14px;color:#252424">Join on your computer, mobile
+app or room device</span></div>
+<a href="https://teams.microsoft.com/l/meetup-join/19%3ameeting_NjQ2ZTc4YjQtZjM
+5%40thread.v2/0?context=%7b%22Tid%22%3a%2272f988bf%22%7d" target="_blank"
+rel="noreferrer noopener">Click here to join the meeting</a>
+<div>Meeting ID: 312 456 789 012<br>Passcode: aBc123</div>
+<a href="https://www.microsoft.com/en-us/microsoft-teams/download-app">
+Download Teams</a> |
+<a href="https://www.microsoft.com/microsoft-teams/join-a-meeting">
+Join on the web</a>
+<div><a href="https://aka.ms/JoinTeamsMeeting">Learn More</a> |
+<a href="https://teams.microsoft.com/meetingOptions/?organizerId=1">
+Meeting options</a></div>
+</body></html>
+"""
+
+ZOOM_INVITE = """
+John Doe is inviting you to a scheduled Zoom meeting.
+
+Topic: Weekly platform sync
+Time: Oct 16, 2026 10:00 AM Europe/Berlin
+
+Join Zoom Meeting
+https://example.zoom.us/j/91234567890?pwd=aGVsbG8gd29ybGQgdGhpcyBpcyBub3QgcmVhbA
+
+Meeting ID: 912 3456 7890
+Passcode: 424242
+
+One tap mobile
++4969380989,,91234567890#,,,,*424242# Germany
++4930567950,,91234567890#,,,,*424242# Germany
+
+Find your local number: https://example.zoom.us/u/abcdEFGh
+"""
+
+MEET_INVITE = """
+Quarterly review with the whole team, please bring your numbers.
+
+Join with Google Meet: https://meet.google.com/abc-defg-hij
+Join by phone: (US) +1 555-123-4567 PIN: 123456789#
+
+Learn more about Meet at: https://support.google.com/a/users/answer/9282720
+"""
+
+WEBEX_INVITE = """
+Join from the meeting link
+https://example.webex.com/example/j.php?MTID=m0123456789abcdef0123456789abcdef
+
+Join by meeting number
+Meeting number (access code): 2345 678 9012
+Meeting password: Sync2026!
+"""
+
+PLAIN_INVITE = """
+Lunch at the usual place. Room booking confirmed for 12 people, see
+https://wiki.example.com/display/TEAM/Offsite+2026 for the agenda and
+https://maps.example.com/?q=Some+Restaurant for directions.
+""" * 3
+
+CORPUS = [
+    {"location": "Microsoft Teams Meeting", "description": TEAMS_INVITE},
+    {"location": None, "description": ZOOM_INVITE},
+    {"location": "Room 4.12", "description": MEET_INVITE},
+    {"location": "", "description": WEBEX_INVITE},
+    {"location": "Cafeteria", "description": PLAIN_INVITE},
+    {
+        "location": "Room 1.01",
+        "description": PLAIN_INVITE,
+        "extra": {
+            "conference_type": 0,
+            "meeting_workspace_url": None,
+            "net_show_url": None,
+        },
+    },
+]
+
+
+def legacy_guess_conference_location(event):
+    # Previous implementation, for comparison
+    fields = [str(event.get("location")), str(event.get("description"))]
+    if "extra" in event:
+        for val in event.get("extra").values():
+            if val:
+                fields.append(str(val))
+    for val in [x for x in fields if x]:
+        for regex in [REGEX_ZOOM_URL, REGEX_MS_TEAMS_URL]:
+            if m := re.findall(regex, val):
+                return m[0]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-n", "--rounds", type=int, default=2000, help="Number of rounds"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    for ev in CORPUS:
+        print(f"{guess_conference_location(ev)!s:.60}")
+
+    def run(func, **kwargs):
+        for ev in CORPUS:
+            func(ev, **kwargs)
+
+    revisions = {id(ev): (i, "rev") for i, ev in enumerate(CORPUS)}
+    benchmarks = {
+        "legacy": lambda: run(legacy_guess_conference_location),
+        "current": lambda: run(guess_conference_location),
+        "current (memoized)": lambda: [
+            guess_conference_location(ev, revision=revisions[id(ev)])
+            for ev in CORPUS
+        ],
+    }
+    for name, func in benchmarks.items():
+        duration = timeit.timeit(func, number=args.rounds)
+        per_event = duration / (args.rounds * len(CORPUS)) * 1e6
+        print(f"{name:20} {duration:8.3f}s  {per_event:8.2f}us/event")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Memory footprint of the events, plain dicts vs jcalapi.events.Event
+# Usage: python benchmarks/event_memory.py [-n EVENTS]
+
+import argparse
+import datetime
+import tracemalloc
+
+from conference_url import TEAMS_INVITE
+
+from jcalapi.events import project_event
+from jcalapi.utils import html_to_text
+
+
+def make_event(i):
+    # Something that looks like an Exchange event, with a fresh copy of all
+    # the strings (as if they had just been parsed)
+    start = datetime.datetime(
+        2026, 10, 1, 9, tzinfo=datetime.timezone.utc
+    ) + datetime.timedelta(hours=i)
+    return {
+        "uid": f"040000008200E00074C5B7101A82E008{i:016d}",
+        "backend": "".join("exchange"),
+        "calendar": "".join(["Team ", "calendar"]),
+        "organizer": "".join(["John ", "Doe"]),
+        "attendees": [
+            {
+                "name": "".join(["Attendee ", str(x)]),
+                "email": "".join([f"attendee{x}", "@example.com"]),
+                "optional": x % 3 == 0,
+                "response": "".join("Accept"),
+            }
+            for x in range(8)
+        ],
+        "summary": f"Weekly sync #{i}",
+        "description": html_to_text(TEAMS_INVITE)[0],
+        "body": "".join(TEAMS_INVITE),
+        "location": "".join("Microsoft Teams Meeting"),
+        "start": start,
+        "end": start + datetime.timedelta(minutes=30),
+        "whole_day": False,
+        "is_recurring": True,
+        "status": "".join("confirmed"),
+        "categories": ["".join("Meetings")],
+        "extra": {
+            "conference_type": 0,
+            "meeting_workspace_url": None,
+            "net_show_url": None,
+        },
+        "conference_url": "https://teams.microsoft.com/l/meetup-join/abc",
+    }
+
+
+def measure(func, count):
+    tracemalloc.start()
+    events = [func(i) for i in range(count)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return events, size
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-n", "--events", type=int, default=5000, help="Number of events"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    benchmarks = {
+        "dict": make_event,
+        "Event": lambda i: project_event(make_event(i), profile="full"),
+    }
+    for name, func in benchmarks.items():
+        _, size = measure(func, args.events)
+        print(
+            f"{name:8} {size / 2**20:8.2f}MiB  "
+            f"{size / args.events / 2**10:8.2f}KiB/event"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Import time of the app (python -X importtime), also checks that none of
+# the backend libraries get imported at startup
+# Usage: python benchmarks/startup.py [-n ROUNDS] [--max-ms MS]
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+MODULE = "jcalapi.app"
+# Only imported when a backend gets used, see jcalapi.backend
+LAZY_MODULES = [
+    "atlassian",
+    "bs4",
+    "exchangelib",
+    "gcsa",
+    "googleapiclient",
+    "icalendar",
+    "recurring_ical_events",
+]
+
+
+def import_times(module):
+    # {module: cumulative import time (in us)}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        res = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            capture_output=True,
+            text=True,
+            check=True,
+            # Don't touch the real cache
+            env={**os.environ, "XDG_CACHE_HOME": tmpdir},
+        )
+    times = {}
+    for line in res.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        try:
+            times[name.strip()] = int(cumulative)
+        except ValueError:
+            continue  # header
+    return times
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-n", "--rounds", type=int, default=5, help="Number of rounds"
+    )
+    parser.add_argument(
+        "--max-ms",
+        type=float,
+        default=None,
+        help="Fail if the (best) import time exceeds this",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    runs = [import_times(MODULE) for _ in range(args.rounds)]
+    best = min(x[MODULE] for x in runs) / 1000
+    print(f"{MODULE:20} {best:8.1f}ms (best of {args.rounds})")
+
+    top = sorted(runs[-1].items(), key=lambda x: x[1], reverse=True)
+    for name, duration in [x for x in top if "." not in x[0]][:8]:
+        print(f"  {name:18} {duration / 1000:8.1f}ms")
+
+    failed = False
+    eager = [
+        x
+        for x in LAZY_MODULES
+        if any(m == x or m.startswith(f"{x}.") for m in runs[-1])
+    ]
+    if eager:
+        print(f"Imported at startup: {', '.join(eager)}")
+        failed = True
+    if args.max_ms is not None and best > args.max_ms:
+        print(f"Import time above {args.max_ms}ms")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
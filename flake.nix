@@ -56,6 +56,7 @@
             httpx
             icalendar
             loguru
+            orjson
             pyPkgs."python-dateutil"
             pyPkgs."python-multipart"
             pyPkgs."recurring-ical-events"
@@ -3,115 +3,371 @@ import datetime
 import logging
 import os
 import re
+import time
 from contextlib import asynccontextmanager
-from contextvars import ContextVar
 from typing import List, Optional
 
-import tzlocal
 import xdg
-from dateutil.parser import parse as dparse
 from diskcache import Cache
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import JSONResponse
 
+import jcalapi.backend as backends
+import jcalapi.jobs as jobs
+import jcalapi.leader as leader
+import jcalapi.persistence as persistence
 import jcalapi.utils as utils
-from jcalapi.backend.confluence import get_confluence_events
-from jcalapi.backend.exchange import get_exchange_events
-from jcalapi.backend.google import get_google_events
+from jcalapi.events import LOCAL_TZ, project_event
+from jcalapi.responses import cached_json_response
+from jcalapi.scheduler import Scheduler, refresh_interval
+from jcalapi.store import EventStore
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    task = asyncio.create_task(_refresh_loop())
+    tasks = [
+        asyncio.create_task(_lease_loop()),
+        asyncio.create_task(_refresh_loop()),
+    ]
     yield
-    task.cancel()
-    try:
-        await task
-    except asyncio.CancelledError:
-        pass
+    for task in tasks:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    leader.release_lease(CACHE)
 
 
 app = FastAPI(lifespan=lifespan)
 
-CALENDAR_DATA = {"confluence": [], "exchange": [], "google": []}
+# One entry per registered backend, see jcalapi.backend
+CALENDAR_DATA = EventStore(backends.registered_backends())
 CACHE = Cache(os.path.join(xdg.xdg_cache_home(), "jcalapi"))
 CACHE_KEY_META_SUFFIX = "-metadata"
-CACHE_EXPIRY = 60 * 10  # 10 minutes
-CACHE_RESTORED = ContextVar("CACHE_RESTORED", default=False)
+# NOTE v2: the sync states hold Event objects
+CACHE_KEY_SYNC_SUFFIX = "-sync-state-v2"
+CACHE_KEY_GENERATION = "generation"
+CACHE_KEY_GENERATION_SUFFIX = "-generation"
+# Set by the leader once it tried to refresh all the backends at startup
+CACHE_KEY_WARMUP = "warmup"
 
 PAST_DAYS_IMPORT = int(os.environ.get("PAST_DAYS_IMPORT", 0))
 FUTURE_DAYS_IMPORT = int(os.environ.get("FUTURE_DAYS_IMPORT", 14))
-START_DATE = (
-    (
-        datetime.datetime.now(tz=tzlocal.get_localzone()).replace(
-            hour=0, minute=0, second=0, microsecond=0
-        )
-        - datetime.timedelta(days=PAST_DAYS_IMPORT)
-    )
-    if PAST_DAYS_IMPORT > 0
-    else None
+
+# Data generations loaded by this worker, bumped in the cache every time a
+# worker stores new events: {backend: generation} plus the global one
+GENERATIONS = {}
+# Minimum delay (in seconds) between two checks of the cache generation
+GENERATION_CHECK_INTERVAL = float(
+    os.environ.get("GENERATION_CHECK_INTERVAL", 1)
 )
-END_DATE = datetime.datetime.now(tz=tzlocal.get_localzone()).replace(
-    hour=0, minute=0, second=0, microsecond=0
-) + datetime.timedelta(days=FUTURE_DAYS_IMPORT)
+_GENERATION_CHECK = {"last": 0.0}
+# Last update of the data of each backend (epoch)
+DATA_UPDATED = {}
+# Startup state: whether the cache got restored and the backends whose
+# first refresh is done
+STARTUP = {"restored": False, "refreshed": set()}
+# Start of this process (epoch), see warmup_needed
+STARTED = time.time()
+_WARMUP = {"task": None}
+
+# Agenda queries outside of the import window fetch the requested day on
+# demand, the results are kept for RANGE_CACHE_TTL seconds
+RANGE_FETCH = os.environ.get("RANGE_FETCH", "true").lower() in [
+    "true",
+    "yes",
+    "1",
+]
+RANGE_CACHE = utils.LRUCache(
+    maxsize=int(os.environ.get("RANGE_CACHE_SIZE", 32)),
+    ttl=int(os.environ.get("RANGE_CACHE_TTL", 60 * 10)),
+)
+# In-flight on demand fetches: {(start, end): asyncio.Task}
+RANGE_FETCHES = {}
+
+# Per-backend timeout (in seconds) for a single refresh, can be overridden
+# with <BACKEND>_RELOAD_TIMEOUT (eg: EXCHANGE_RELOAD_TIMEOUT=600)
+RELOAD_TIMEOUT = int(os.environ.get("RELOAD_TIMEOUT", 300))
+# Backend instances: {name: jcalapi.backend.Backend}
+PLUGINS = {}
 
 LOGGER = logging.getLogger(__name__)
 
 
+def import_window(now=None):
+    # Window of the events to import, it slides along with the current day:
+    # - start: PAST_DAYS_IMPORT days ago, or last monday
+    # - end: in FUTURE_DAYS_IMPORT days
+    today = (now or datetime.datetime.now(tz=LOCAL_TZ)).replace(
+        hour=0, minute=0, second=0, microsecond=0
+    )
+    start = today - datetime.timedelta(
+        days=PAST_DAYS_IMPORT if PAST_DAYS_IMPORT > 0 else today.weekday()
+    )
+    end = today + datetime.timedelta(days=FUTURE_DAYS_IMPORT)
+    return start, end
+
+
 def events_merged(ignore_calendars: Optional[List[str]] = None):
-    merged = []
-    for vals in CALENDAR_DATA.values():
-        values = (
-            [x for x in vals if x.get("calendar") not in ignore_calendars]
-            if ignore_calendars
-            else vals
-        )
-        merged += values
-    return merged
+    return CALENDAR_DATA.merged(ignore_calendars)
 
 
 def cache_events(key):
-    res_data = CACHE.set(key, CALENDAR_DATA[key], expire=CACHE_EXPIRY)
+    # NOTE The events are kept indefinitely: stale data (see data_age) is
+    # still better than no data at all while the backends get refreshed
+    res_data = persistence.save_events(CACHE, key, CALENDAR_DATA[key])
     # Save metadata
     meta = {
         "last-update": datetime.datetime.now(),
         "entries": len(CALENDAR_DATA[key]),
     }
     res_meta = CACHE.set(f"{key}{CACHE_KEY_META_SUFFIX}", meta)
+    DATA_UPDATED[key] = time.time()
+    # Let the other workers know
+    GENERATIONS[key] = CACHE.incr(f"{key}{CACHE_KEY_GENERATION_SUFFIX}")
+    CACHE.incr(CACHE_KEY_GENERATION)
     return res_data, res_meta
 
 
-async def cache_restore():
-    # Load data from cache
-    # NOTE: This requires CALENDAR_DATA to be properly initialized (with all
-    # the backends as keys)
+def cache_sync():
+    # Load the backends whose data was updated in the cache (by another
+    # worker) since we last looked
+    generation = CACHE.get(CACHE_KEY_GENERATION, 0)
+    if generation == GENERATIONS.get(CACHE_KEY_GENERATION):
+        return False
     for key in CALENDAR_DATA.keys():
-        cached_data = CACHE.get(key)
+        key_generation = CACHE.get(f"{key}{CACHE_KEY_GENERATION_SUFFIX}", 0)
+        if key_generation == GENERATIONS.get(key):
+            continue
+        try:
+            cached_data = persistence.load_events(CACHE, key)
+        except Exception as exc:
+            # Keep the data we have, don't try again until it gets updated
+            LOGGER.exception(f"Failed to load {key} data from cache: {exc}")
+            cached_data = None
         if cached_data:
             CALENDAR_DATA[key] = cached_data
+            meta = CACHE.get(f"{key}{CACHE_KEY_META_SUFFIX}") or {}
+            last_update = meta.get("last-update")
+            DATA_UPDATED[key] = (
+                last_update.timestamp() if last_update else time.time()
+            )
             LOGGER.info(f"Loaded {key} data from cache")
-        else:
-            LOGGER.warning(f"Cache for {key} is empty. Requesting refresh")
-            if key == "exchange":
-                await reload_exchange()
-            elif key == "confluence":
-                await reload_confluence()
-            elif key == "google":
-                await reload_google()
+        GENERATIONS[key] = key_generation
+    GENERATIONS[CACHE_KEY_GENERATION] = generation
+    return True
+
+
+async def load_backend(backend):
+    # The backends are imported on first use (see jcalapi.backend), which
+    # may take a while: do it in a thread not to block the event loop
+    plugin = PLUGINS.get(backend)
+    if plugin is None:
+        plugin = await asyncio.to_thread(
+            backends.load_backend, backend, cache=CACHE
+        )
+        PLUGINS[backend] = plugin
+    return plugin
+
+
+def reload_timeout(backend):
+    return int(
+        os.environ.get(f"{backend.upper()}_RELOAD_TIMEOUT", RELOAD_TIMEOUT)
+    )
+
+
+async def _timed_reload(backend, coro):
+    # Run a single backend refresh with its own timeout. Errors are logged
+    # and reported but never propagated, so that a failing backend does not
+    # affect the other ones (its previous data is kept as is).
+    timeout = reload_timeout(backend)
+    started = time.monotonic()
+    try:
+        # NOTE the result may be shared with other callers (single flight)
+        res = dict(await asyncio.wait_for(coro, timeout=timeout))
+    except asyncio.TimeoutError:
+        LOGGER.error(f"Refreshing {backend} timed out after {timeout}s")
+        res = {"events": None, "error": f"Timed out after {timeout}s"}
+    except Exception as exc:
+        LOGGER.exception(f"Refreshing {backend} failed: {exc}")
+        res = {"events": None, "error": str(exc)}
+    res["duration"] = round(time.monotonic() - started, 3)
+    LOGGER.info(f"Refreshed {backend} in {res['duration']}s")
+    return res
+
+
+async def refresh_backends(reloaders):
+    # Fan out all the backend refreshes at once.
+    # reloaders: {backend: coroutine}
+    results = await asyncio.gather(
+        *(_timed_reload(k, v) for k, v in reloaders.items())
+    )
+    return dict(zip(reloaders.keys(), results))
+
+
+def sync_state_restore(key):
+    # State of the incremental syncs (sync tokens etc), see the backends
+    return persistence.load_state(
+        CACHE, f"{key}{CACHE_KEY_SYNC_SUFFIX}", key, default={}
+    )
+
 
+def sync_state_save(key, state):
+    # NOTE the events of the state are stored as references to the event
+    # records, saved by cache_events
+    return persistence.save_state(
+        CACHE, f"{key}{CACHE_KEY_SYNC_SUFFIX}", key, state
+    )
+
+
+async def cache_restore():
+    # Load data from cache, however old it is, so that it can be served
+    # right away. Then refresh (concurrently) the backends whose data is
+    # missing or stale.
+    # NOTE: This requires CALENDAR_DATA to be properly initialized (with all
+    # the backends as keys)
+    cache_sync()
+    STARTUP["restored"] = True
     LOGGER.info("Cached values have been restored")
-    CACHE_RESTORED.set(True)
 
+    task = ensure_warmup()
+    if task is not None:
+        await task
+    elif not leader.is_leader():
+        LOGGER.info("Waiting for the leader to refresh the backends")
 
-async def _refresh_loop():
-    while True:
-        cache_restored = CACHE_RESTORED.get(False)
-        LOGGER.info(f"Refresh tick -> CACHE_RESTORED={cache_restored}")
-        if not cache_restored:
-            await cache_restore()
+
+def warmup_needed():
+    # The warm-up has not been done (by any worker) since this process
+    # started, eg: the previous leader crashed, or its lease had to expire
+    # before we could take over
+    warmup = CACHE.get(CACHE_KEY_WARMUP)
+    return warmup is None or warmup < STARTED
+
+
+def ensure_warmup():
+    # Start the warm-up once this worker is the leader (unless it is running
+    # or was done already), returns its task
+    task = _WARMUP["task"]
+    if task is not None and not task.done():
+        return task
+    if (
+        not STARTUP["restored"]
+        or not leader.is_leader()
+        or not warmup_needed()
+    ):
+        return None
+    task = asyncio.create_task(warmup())
+    _WARMUP["task"] = task
+    return task
+
+
+async def warmup():
+    # Refresh (concurrently) the backends whose data is missing or stale
+    CACHE.delete(CACHE_KEY_WARMUP)
+    cache_sync()
+    ages = data_age()
+    outdated = {}
+    for key in CALENDAR_DATA.keys():
+        if key not in ages:
+            LOGGER.warning(f"Cache for {key} is empty. Requesting refresh")
+        elif ages[key] > refresh_interval(key):
+            LOGGER.info(f"Cache for {key} is {ages[key]}s old. Refreshing")
         else:
-            LOGGER.info("Refreshing events data")
-            await reload()
-        await asyncio.sleep(60 * 5)
+            STARTUP["refreshed"].add(key)
+            continue
+        outdated[key] = reload_backend(key)
+
+    if outdated:
+        await refresh_backends(outdated)
+    STARTUP["refreshed"].update(outdated)
+    CACHE.set(CACHE_KEY_WARMUP, time.time())
+
+
+def data_age():
+    # Age (in seconds) of the data of each backend
+    now = time.time()
+    return {k: round(now - v) for k, v in DATA_UPDATED.items()}
+
+
+async def _lease_loop():
+    while True:
+        leader.renew_lease(CACHE)
+        # Whoever becomes the leader takes care of the warm-up
+        ensure_warmup()
+        await asyncio.sleep(leader.LEADER_LEASE / 3)
+
+
+async def scheduled_reload(backend):
+    # Only the leader refreshes the backends, see leader.py
+    if not leader.is_leader():
+        cache_sync()
+        return None
+    # Drop the events that fell off the import window
+    CALENDAR_DATA.evict(before=import_window()[0])
+    res = await refresh_backends({backend: reload_backend(backend)})
+    return res[backend]
+
+
+def next_event_start(backend):
+    return CALENDAR_DATA.next_start(
+        backend, datetime.datetime.now(tz=LOCAL_TZ)
+    )
+
+
+async def _refresh_loop():
+    leader.renew_lease(CACHE)
+    await cache_restore()
+    await Scheduler(
+        CALENDAR_DATA.keys(), scheduled_reload, next_event_start
+    ).run()
+
+
+@app.middleware("http")
+async def follow_cache(request: Request, call_next):
+    # Cheap check (throttled) for data stored by another worker.
+    # NOTE the liveness probe must not depend on the cache
+    now = time.monotonic()
+    if (
+        request.url.path != "/healthz"
+        and now - _GENERATION_CHECK["last"] >= GENERATION_CHECK_INTERVAL
+    ):
+        _GENERATION_CHECK["last"] = now
+        try:
+            cache_sync()
+        except Exception as exc:
+            # Serve the data we already have
+            LOGGER.exception(f"Failed to sync with the cache: {exc}")
+    response = await call_next(request)
+    if ages := data_age():
+        response.headers["X-Data-Age"] = str(max(ages.values()))
+    return response
+
+
+@app.get("/healthz")
+async def healthz():
+    # Liveness: the server is up and running
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz():
+    # Readiness: there is data to serve (however stale it is, see
+    # X-Data-Age), or the first refresh of the backends without any is done
+    pending = [
+        x
+        for x in CALENDAR_DATA.keys()
+        if x not in DATA_UPDATED and x not in STARTUP["refreshed"]
+    ]
+    # NOTE followers only know that the leader is done refreshing
+    ready = STARTUP["restored"] and (
+        not pending or (not leader.is_leader() and CACHE_KEY_WARMUP in CACHE)
+    )
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"ready": ready, "pending": pending, "age": data_age()},
+    )
 
 
 @app.post("/reload")
@@ -125,81 +381,69 @@ async def reload(
     exchange_shared_inboxes: Optional[List[str]] = None,
     google_credentials: Optional[str] = None,
     google_calendar_regex: Optional[str] = None,
+    wait: Optional[bool] = True,
 ):
-    if exchange_shared_inboxes is None:
-        exchange_shared_inboxes = []
-    res_google = await reload_google(
-        credentials=google_credentials,
-        calendar_regex=google_calendar_regex,
-    )
-    res_confluence = await reload_confluence(
-        url=confluence_url,
-        username=confluence_username,
-        password=confluence_password,
-    )
-    res_exchange = await reload_exchange(
-        username=exchange_username,
-        password=exchange_password,
-        email=exchange_email,
-        shared_inboxes=exchange_shared_inboxes,
-    )
-    return {
-        "exchange": res_exchange,
-        "confluence": res_confluence,
-        "google": res_google,
+    params = {
+        "confluence": {
+            "url": confluence_url,
+            "username": confluence_username,
+            "password": confluence_password,
+        },
+        "exchange": {
+            "username": exchange_username,
+            "password": exchange_password,
+            "email": exchange_email,
+            "shared_inboxes": exchange_shared_inboxes,
+        },
+        "google": {
+            "credentials": google_credentials,
+            "calendar_regex": google_calendar_regex,
+        },
     }
 
+    if not wait:
+        # Start (or join) the refresh of every backend, return the jobs
+        return {
+            k: await reload_backend(k, params.get(k), wait=False)
+            for k in CALENDAR_DATA.keys()
+        }
+
+    return await refresh_backends(
+        {k: reload_backend(k, params.get(k)) for k in CALENDAR_DATA.keys()}
+    )
+
+
+@app.get("/jobs")
+async def get_jobs():
+    return jobs.running_jobs()
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = jobs.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+    return job
+
 
 @app.post("/reload/confluence")
 async def reload_confluence(
     url: Optional[str] = None,
     username: Optional[str] = None,
     password: Optional[str] = None,
-    convert_email: Optional[bool] = False,
+    convert_email: Optional[bool] = None,
+    wait: Optional[bool] = True,
 ):
-    confluence_url = url if url else os.environ.get("CONFLUENCE_URL")
-    confluence_username = (
-        username if username else os.environ.get("CONFLUENCE_USERNAME")
-    )
-    confluence_password = (
-        password if password else os.environ.get("CONFLUENCE_PASSWORD")
+    return await reload_backend(
+        "confluence",
+        {
+            "url": url,
+            "username": username,
+            "password": password,
+            "convert_email": convert_email,
+        },
+        wait=wait,
     )
-    convert_email = (
-        convert_email
-        if convert_email
-        else os.environ.get("CONFLUENCE_CONVERT_EMAIL", "false")
-        in ["true", "yes", "1"]
-    )
-    backend = "confluence"
-
-    if (
-        not confluence_url
-        or not confluence_username
-        or not confluence_password
-    ):
-        LOGGER.warning(
-            "Confluence URL, username and password are "
-            "required to fetch events"
-        )
-        return {"events": None}
-
-    if confluence_url:
-        LOGGER.info(f"Fetch calendar events from Confluence: {confluence_url}")
-        if START_DATE is not None or END_DATE is not None:
-            LOGGER.info(
-                f"Collecting events - Start={START_DATE}, End={END_DATE}"
-            )
-        CALENDAR_DATA[backend] = await get_confluence_events(
-            url=confluence_url,
-            username=confluence_username,
-            password=confluence_password,
-            convert_email=convert_email,
-            start=START_DATE,
-            end=END_DATE,
-        )
-        cache_events(backend)
-
-    return {"events": len(CALENDAR_DATA.get(backend, []))}
 
 
 @app.post("/reload/exchange")
@@ -208,132 +452,188 @@ async def reload_exchange(
     username: Optional[str] = None,
     password: Optional[str] = None,
     shared_inboxes: Optional[List[str]] = None,
-    autodiscovery: Optional[bool] = True,
+    autodiscovery: Optional[bool] = None,
     service_endpoint: Optional[str] = None,
     auth_type: Optional[str] = None,
     version: Optional[str] = None,
+    incremental: Optional[bool] = None,
+    wait: Optional[bool] = True,
 ):
-    if shared_inboxes is None:
-        shared_inboxes = []
-    exchange_email = email if email else os.environ.get("EXCHANGE_EMAIL")
-    exchange_username = (
-        username if username else os.environ.get("EXCHANGE_USERNAME")
-    )
-    exchange_password = (
-        password if password else os.environ.get("EXCHANGE_PASSWORD")
-    )
-    exchange_autodiscovery = (
-        autodiscovery
-        if autodiscovery
-        else os.environ.get("EXCHANGE_AUTODISCOVERY", "true").lower()
-        in ["true", "yes", "1", "enable"]
-    )
-    exchange_service_endpoint = (
-        service_endpoint
-        if service_endpoint
-        else os.environ.get("EXCHANGE_SERVICE_ENDPOINT")
-    )
-    exchange_auth_type = (
-        auth_type if auth_type else os.environ.get("EXCHANGE_AUTH_TYPE")
+    return await reload_backend(
+        "exchange",
+        {
+            "email": email,
+            "username": username,
+            "password": password,
+            "shared_inboxes": shared_inboxes,
+            "autodiscovery": autodiscovery,
+            "service_endpoint": service_endpoint,
+            "auth_type": auth_type,
+            "version": version,
+            "incremental": incremental,
+        },
+        wait=wait,
     )
-    exchange_version = (
-        version if version else os.environ.get("EXCHANGE_VERSION")
-    )
-    exchange_shared_inboxes = (
-        shared_inboxes
-        if shared_inboxes
-        else [
-            x.strip()
-            for x in os.environ.get("EXCHANGE_SHARED_INBOXES", "").split(",")
-        ]
-    )
-
-    backend = "exchange"
-
-    if not exchange_username or not exchange_password:
-        LOGGER.warning(
-            "Exchange username and password are required to fetch events"
-        )
-        return {"events": None}
-
-    LOGGER.info(
-        f"Fetch calendar events from Exchange for user {exchange_username}"
-    )
-    if START_DATE is not None or END_DATE is not None:
-        LOGGER.info(f"Collecting events - Start={START_DATE}, End={END_DATE}")
-
-    CALENDAR_DATA[backend] = await get_exchange_events(
-        username=exchange_username,
-        email=exchange_email,
-        password=exchange_password,
-        shared_inboxes=exchange_shared_inboxes,
-        autodiscovery=exchange_autodiscovery,
-        service_endpoint=exchange_service_endpoint,
-        version=exchange_version,
-        auth_type=exchange_auth_type,
-        start=START_DATE,
-        end=END_DATE,
-    )
-
-    cache_events(backend)
-
-    return {"events": len(CALENDAR_DATA.get(backend, []))}
 
 
 @app.post("/reload/google")
 async def reload_google(
     credentials: Optional[str] = None,
     calendar_regex: Optional[str] = None,
+    incremental: Optional[bool] = None,
+    wait: Optional[bool] = True,
 ):
-    google_credentials = (
-        credentials if credentials else os.environ.get("GOOGLE_CREDENTIALS")
+    return await reload_backend(
+        "google",
+        {
+            "credentials": credentials,
+            "calendar_regex": calendar_regex,
+            "incremental": incremental,
+        },
+        wait=wait,
     )
-    google_calendar_regex = (
-        calendar_regex
-        if calendar_regex is not None
-        else os.environ.get("GOOGLE_CALENDAR_REGEX", "")
+
+
+@app.post("/reload/{backend}")
+async def reload_named_backend(backend: str, wait: Optional[bool] = True):
+    # Any other (plugin) backend, configured through its env vars
+    if backend not in CALENDAR_DATA.keys():
+        raise HTTPException(
+            status_code=404, detail=f"Unknown backend: {backend}"
+        )
+    return await reload_backend(backend, wait=wait)
+
+
+async def reload_backend(backend, params=None, wait=True):
+    # params: settings of the backend that override its env vars, see
+    # jcalapi.backend.Backend.settings
+    params = {k: v for k, v in (params or {}).items() if v is not None}
+    return await jobs.single_flight(
+        (
+            backend,
+            *(
+                (k, tuple(v) if isinstance(v, list) else v)
+                for k, v in sorted(params.items())
+            ),
+        ),
+        f"reload/{backend}",
+        lambda: _reload_backend(backend, params),
+        wait=wait,
+        # The shared run itself must be bounded: callers that time out
+        # (see _timed_reload) only stop waiting for it
+        timeout=reload_timeout(backend),
     )
 
-    backend = "google"
 
-    if not google_credentials:
-        LOGGER.warning("Google credentials are required to fetch events")
+async def fetch_events(plugin, window, since_state, settings):
+    events, state = await plugin.fetch(window, since_state, **settings)
+    if not plugin.projection:
+        events = [project_event(x) for x in events]
+    return events, state
+
+
+async def _reload_backend(backend, params):
+    plugin = await load_backend(backend)
+    settings = plugin.settings(**params)
+    if settings is None:
         return {"events": None}
 
-    LOGGER.info("Fetching calendar events from google")
-    if START_DATE is not None or END_DATE is not None:
-        LOGGER.info(f"Collecting events - Start={START_DATE}, End={END_DATE}")
-    CALENDAR_DATA[backend] = await get_google_events(
-        credentials=google_credentials,
-        calendar_regex=google_calendar_regex,
-        start=START_DATE,
-        end=END_DATE,
+    start, end = import_window()
+    LOGGER.info(f"Collecting {backend} events - Start={start}, End={end}")
+    since_state = sync_state_restore(backend) if plugin.incremental else None
+    CALENDAR_DATA[backend], state = await fetch_events(
+        plugin, (start, end), since_state, settings
     )
     cache_events(backend)
+    if state is not None:
+        sync_state_save(backend, state)
 
     return {"events": len(CALENDAR_DATA.get(backend, []))}
 
 
+async def _fetch_range(start, end):
+    # Fetch the events in [start, end] from all the configured backends,
+    # without touching CALENDAR_DATA
+    async def fetch(plugin, settings):
+        events, _ = await fetch_events(plugin, (start, end), None, settings)
+        return {"events": events}
+
+    fetchers = {}
+    for backend in CALENDAR_DATA.keys():
+        plugin = await load_backend(backend)
+        if (settings := plugin.settings()) is not None:
+            fetchers[backend] = fetch(plugin, settings)
+
+    results = await refresh_backends(fetchers)
+    store = EventStore(CALENDAR_DATA.keys())
+    for backend, res in results.items():
+        if res["events"] is not None:
+            store[backend] = res["events"]
+    complete = all(x["events"] is not None for x in results.values())
+    return store, complete
+
+
+async def fetch_range(start, end):
+    """
+    Events in [start, end] fetched on demand, for the dates that are not
+    part of the import window. Returns (fetch time, EventStore).
+    """
+    key = (start, end)
+    cached = RANGE_CACHE.get(key)
+    if cached is not None:
+        return cached
+
+    # Concurrent requests for the same range share a single fetch
+    task = RANGE_FETCHES.get(key)
+    if task is None:
+
+        async def run():
+            LOGGER.info(
+                f"Fetching events on demand - Start={start}, End={end}"
+            )
+            store, complete = await _fetch_range(start, end)
+            res = (time.monotonic(), store)
+            if complete:
+                RANGE_CACHE.set(key, res)
+            return res
+
+        task = asyncio.create_task(run())
+        RANGE_FETCHES[key] = task
+        task.add_done_callback(lambda _: RANGE_FETCHES.pop(key, None))
+    # Don't cancel the shared fetch if this request gets cancelled
+    return await asyncio.shield(task)
+
+
 @app.get("/events")
 @app.get("/events/{backend}")
 @app.get("/events/{backend}/{calendar}")
 async def events(
-    backend: Optional[str] = "all", calendar: Optional[str] = "all"
+    request: Request,
+    backend: Optional[str] = "all",
+    calendar: Optional[str] = "all",
 ):
     if backend and backend != "all" and backend not in CALENDAR_DATA.keys():
         raise HTTPException(
             status_code=404, detail=f"Unknown backend: {backend}"
         )
 
-    res = (
-        CALENDAR_DATA.get(backend, [])
-        if (backend and backend != "all")
-        else events_merged()
+    def get_events():
+        res = (
+            CALENDAR_DATA.get(backend, [])
+            if (backend and backend != "all")
+            else events_merged()
+        )
+        if calendar and calendar != "all":
+            LOGGER.info(f"Filtering events by calendar name: {calendar}")
+            res = [x for x in res if x.calendar == calendar]
+        return res
+
+    return cached_json_response(
+        request,
+        ("events", backend, calendar),
+        CALENDAR_DATA.generation,
+        get_events,
     )
-    if calendar and calendar != "all":
-        LOGGER.info(f"Filtering events by calendar name: {calendar}")
-        res = [x for x in res if x.get("calendar") == calendar]
-    return res
 
 
 @app.get("/meta")
@@ -351,70 +651,80 @@ async def get_metadata(backend: Optional[str] = "all"):
 
 @app.get("/now")
 async def get_current_events(
+    request: Request,
     ignore_calendars: Optional[List[str]] = Query(None),
 ):
-    agenda = await get_events_at_date(
-        "today", ignore_calendars=ignore_calendars
+    now = datetime.datetime.now(tz=LOCAL_TZ)
+    current_events = CALENDAR_DATA.at(now, ignore_calendars=ignore_calendars)
+    for ev in current_events:
+        LOGGER.info(f"Event {ev} is happening NOW")
+    return _events_response(
+        request, "now", current_events, CALENDAR_DATA.generation
     )
-    now = datetime.datetime.now(tz=tzlocal.get_localzone())
-    current_events = []
-    for ev in agenda:
-        ev_start = ev.get("start")
-        ev_end = ev.get("end")
-        if isinstance(ev_start, str):
-            ev_start = dparse(ev_start)
-        if isinstance(ev_end, str):
-            ev_end = dparse(ev_end)
-        if ev_start < now < ev_end:
-            LOGGER.info(f"Event {ev} is happening NOW")
-            current_events.append(ev)
-    return current_events
 
 
 @app.get("/today")
 @app.get("/today/{hours_prior}")
 async def get_todays_agenda(
-    ignore_calendars: Optional[List[str]] = Query(None), hours_prior: int = 0
+    request: Request,
+    ignore_calendars: Optional[List[str]] = Query(None),
+    hours_prior: int = 0,
 ):
-    agenda = await get_events_at_date(
+    agenda, version = await events_at_date(
         "today", ignore_calendars=ignore_calendars
     )
-    now = datetime.datetime.now(tz=tzlocal.get_localzone())
-    # now = datetime.datetime.now()
+    now = datetime.datetime.now(tz=LOCAL_TZ)
     target_date = now + datetime.timedelta(hours=hours_prior)
     LOGGER.info(f"Get agenda for today's events - {hours_prior} hour")
-    current_agenda = []
-    for event in agenda:
-        ev_end = event.get("end")
-        if isinstance(ev_end, str):
-            ev_end = dparse(ev_end)
-        # Whole day events
-        if not isinstance(ev_end, datetime.datetime):
-            current_agenda.append(event)
-        else:
-            if not ev_end.tzinfo:
-                ev_end = ev_end.replace(tzinfo=tzlocal.get_localzone())
-            if ev_end >= target_date:
-                current_agenda.append(event)
-    return current_agenda
+    return _events_response(
+        request,
+        "today",
+        [ev for ev in agenda if ev.end >= target_date],
+        version,
+    )
 
 
 @app.get("/tom")
 @app.get("/tomorrow")
 async def get_tomorrows_agenda(
+    request: Request,
     ignore_calendars: Optional[List[str]] = Query(None),
 ):
     return await get_events_at_date(
-        when="tomorrow", ignore_calendars=ignore_calendars
+        request, when="tomorrow", ignore_calendars=ignore_calendars
     )
 
 
 @app.get("/agenda/{when}")
 async def get_events_at_date(
+    request: Request,
     when: Optional[str] = "today",
     ignore_calendars: Optional[List[str]] = Query(None),
 ):
-    now = datetime.datetime.now(tz=tzlocal.get_localzone())
+    agenda, version = await events_at_date(
+        when, ignore_calendars=ignore_calendars
+    )
+    return _events_response(request, "agenda", agenda, version)
+
+
+def _events_response(request, endpoint, events, version):
+    # The events are the very objects held by CALENDAR_DATA (or a store of
+    # events fetched on demand), so as long as the version (generation or
+    # fetch time) doesn't change their IDs identify the response.
+    return cached_json_response(
+        request,
+        (endpoint, request.url.path, request.url.query),
+        (version, tuple(id(x) for x in events)),
+        events,
+    )
+
+
+async def events_at_date(
+    when: Optional[str] = "today",
+    ignore_calendars: Optional[List[str]] = None,
+):
+    # Returns the events along with the version of the data they come from
+    now = datetime.datetime.now(tz=LOCAL_TZ)
     target_date = now  # default to today ie now
 
     if when in ["tomorrow", "tom"]:
@@ -428,47 +738,22 @@ async def get_events_at_date(
 
     LOGGER.info(f"Grabbing agenda for {target_date}")
 
-    agenda = []
-
-    for ev in events_merged(ignore_calendars):
-        LOGGER.debug(
-            f"ITEM DATES {ev.get('summary')}: {ev.get('start')} ({type(ev.get('start'))}) -> {ev.get('end')} ({type(ev.get('end'))})"  # noqa: E501
+    day = target_date.date()
+    start, end = import_window()
+    if RANGE_FETCH and not start.date() <= day < end.date():
+        # Outside of the import window, fetch that day only
+        day_start = datetime.datetime.combine(
+            day, datetime.time.min, tzinfo=LOCAL_TZ
         )
-        ev_start = ev.get("start")
-        ev_end = ev.get("end")
-        if isinstance(ev_start, str):
-            ev_start = dparse(ev_start)
-        if isinstance(ev_end, str):
-            ev_end = dparse(ev_end)
-        ev_start_date = (
-            ev_start.date()
-            if isinstance(ev_start, datetime.datetime)
-            else ev_start
+        fetched, store = await fetch_range(
+            day_start, day_start + datetime.timedelta(days=1)
         )
-        ev_end_date = (
-            ev_end.date() if isinstance(ev_end, datetime.datetime) else ev_end
+        return (
+            store.on_date(day, ignore_calendars=ignore_calendars),
+            ("range", fetched),
         )
-        LOGGER.debug(f"compare: {ev_start}/{ev_end} with {target_date}")
-        LOGGER.debug(f"{ev_start_date} vs {target_date.date()}")
-        if (
-            ev_start_date == target_date.date()
-            or ev_end_date == target_date.date()
-        ):
-            # FIXME Won't this prevent events that occur multiple times
-            # in a day from being included more than once?
-            if ev.get("uid") in [x.get("uid") for x in agenda]:
-                LOGGER.warning(f"Duplicate event skipped: {ev}")
-                continue
-            agenda.append(ev)
-
-    # remove duplicate entries from agenda
-    # agenda = [dict(t) for t in {tuple(d.items()) for d in agenda}]
-
-    # Sort by start time
-    return agenda
-    # return sorted(
-    #     agenda,
-    #     key=lambda d: d["start"]
-    #     if isinstance(d["start"], datetime.date)
-    #     else dparse(d["start"]),
-    # )
+
+    return (
+        CALENDAR_DATA.on_date(day, ignore_calendars=ignore_calendars),
+        CALENDAR_DATA.generation,
+    )
@@ -1,4 +1,98 @@
-from .confluence import get_confluence_events
-from .exchange import get_exchange_events
+import importlib
+from importlib.metadata import EntryPoint, entry_points
 
-__all__ = ["get_confluence_events", "get_exchange_events"]
+# Backends are plugins (see Backend below), registered under this entry point
+# group. eg: in the pyproject.toml of a third-party package:
+# [project.entry-points."jcalapi.backends"]
+# caldav = "jcalapi_caldav:CalDAVBackend"
+ENTRY_POINT_GROUP = "jcalapi.backends"
+# The built-in ones are also registered in our own pyproject.toml, this is
+# for when the package metadata is not available (eg: running from source)
+BUILTIN_BACKENDS = {
+    "confluence": "jcalapi.backend.builtin:ConfluenceBackend",
+    "exchange": "jcalapi.backend.builtin:ExchangeBackend",
+    "google": "jcalapi.backend.builtin:GoogleBackend",
+}
+
+# The backends (and their dependencies: exchangelib, gcsa, atlassian,
+# icalendar...) are only imported when they are first used, see PEP 562
+_LAZY = {
+    "get_confluence_events": "jcalapi.backend.confluence",
+    "get_exchange_events": "jcalapi.backend.exchange",
+    "get_google_events": "jcalapi.backend.google",
+}
+
+__all__ = [
+    "Backend",
+    "ENTRY_POINT_GROUP",
+    "load_backend",
+    "registered_backends",
+    *_LAZY,
+]
+
+
+class Backend:
+    """
+    Base class of the backends.
+
+    - incremental: whether fetch() can sync incrementally, from the state
+      returned by the previous fetch
+    - projection: whether the events returned by fetch() are already
+      projected on the field profile (see events.project_event), otherwise
+      the app takes care of it
+    """
+
+    incremental = False
+    projection = False
+
+    def __init__(self, name, cache=None):
+        self.name = name
+        # Shared persistent cache (diskcache.Cache), for the backends that
+        # need to keep some state of their own
+        self.cache = cache
+
+    def settings(self, **params):
+        """
+        Settings of the backend (the params override the env vars), passed
+        as keyword arguments to fetch(). None if it is not configured.
+        """
+        raise NotImplementedError
+
+    async def fetch(self, window, since_state=None, **settings):
+        """
+        Events in the window ((start, end) datetimes), returns (events, state).
+        since_state is the state returned by the previous fetch ({} if
+        there is none yet), or None for a one-off fetch. The state returned
+        gets persisted by the app, None if there is nothing to keep.
+        """
+        raise NotImplementedError
+
+
+def registered_backends():
+    # {name: entry point} of the available backends, nothing gets imported
+    backends = {
+        k: EntryPoint(k, v, ENTRY_POINT_GROUP)
+        for k, v in BUILTIN_BACKENDS.items()
+    }
+    backends.update({x.name: x for x in entry_points(group=ENTRY_POINT_GROUP)})
+    return backends
+
+
+def load_backend(name, cache=None):
+    entry_point = registered_backends().get(name)
+    if entry_point is None:
+        raise KeyError(f"Unknown backend: {name}")
+    return entry_point.load()(name, cache=cache)
+
+
+def __getattr__(name):
+    module = _LAZY.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,243 @@
+# coding: utf-8
+
+# The built-in backends. This module is imported at startup: the actual
+# implementations (and their dependencies) only get imported on first fetch.
+
+import asyncio
+import logging
+import os
+from typing import List, Optional
+
+import jcalapi.backend as backends
+from jcalapi.backend import Backend
+
+LOGGER = logging.getLogger(__name__)
+
+CACHE_KEY_CONNECTION_SUFFIX = "-connection"
+
+
+def env_flag(name, default="false"):
+    return os.environ.get(name, default).lower() in [
+        "true",
+        "yes",
+        "1",
+        "enable",
+    ]
+
+
+async def _load(name):
+    # Importing a backend takes a while, don't block the event loop
+    return await asyncio.to_thread(getattr, backends, name)
+
+
+class ConfluenceBackend(Backend):
+    # The ICS of the sub-calendars are only fetched (and parsed) again when
+    # they changed, see confluence.fetch_calendar_events
+    incremental = True
+    projection = True
+
+    def settings(
+        self,
+        url: Optional[str] = None,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        convert_email: Optional[bool] = None,
+    ):
+        confluence_url = url if url else os.environ.get("CONFLUENCE_URL")
+        confluence_username = (
+            username if username else os.environ.get("CONFLUENCE_USERNAME")
+        )
+        confluence_password = (
+            password if password else os.environ.get("CONFLUENCE_PASSWORD")
+        )
+        convert_email = (
+            convert_email
+            if convert_email is not None
+            else env_flag("CONFLUENCE_CONVERT_EMAIL")
+        )
+
+        if (
+            not confluence_url
+            or not confluence_username
+            or not confluence_password
+        ):
+            LOGGER.warning(
+                "Confluence URL, username and password are "
+                "required to fetch events"
+            )
+            return None
+
+        return {
+            "url": confluence_url,
+            "username": confluence_username,
+            "password": confluence_password,
+            "convert_email": convert_email,
+        }
+
+    async def fetch(self, window, since_state=None, **settings):
+        LOGGER.info(
+            f"Fetch calendar events from Confluence: {settings['url']}"
+        )
+        persist_parse_cache = env_flag("CONFLUENCE_PARSE_CACHE_PERSIST")
+        sync_state = {} if since_state is None else since_state
+        get_events = await _load("get_confluence_events")
+        events = await get_events(
+            **settings,
+            start=window[0],
+            end=window[1],
+            sync_state=sync_state,
+            parse_cache=self.cache if persist_parse_cache else None,
+        )
+        return events, sync_state
+
+
+class ExchangeBackend(Backend):
+    incremental = True
+    projection = True
+
+    def settings(
+        self,
+        email: Optional[str] = None,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        shared_inboxes: Optional[List[str]] = None,
+        autodiscovery: Optional[bool] = None,
+        service_endpoint: Optional[str] = None,
+        auth_type: Optional[str] = None,
+        version: Optional[str] = None,
+        incremental: Optional[bool] = None,
+    ):
+        exchange_email = email if email else os.environ.get("EXCHANGE_EMAIL")
+        exchange_username = (
+            username if username else os.environ.get("EXCHANGE_USERNAME")
+        )
+        exchange_password = (
+            password if password else os.environ.get("EXCHANGE_PASSWORD")
+        )
+        exchange_autodiscovery = (
+            autodiscovery
+            if autodiscovery is not None
+            else env_flag("EXCHANGE_AUTODISCOVERY", "true")
+        )
+        exchange_service_endpoint = (
+            service_endpoint
+            if service_endpoint
+            else os.environ.get("EXCHANGE_SERVICE_ENDPOINT")
+        )
+        exchange_auth_type = (
+            auth_type if auth_type else os.environ.get("EXCHANGE_AUTH_TYPE")
+        )
+        exchange_version = (
+            version if version else os.environ.get("EXCHANGE_VERSION")
+        )
+        exchange_shared_inboxes = (
+            shared_inboxes
+            if shared_inboxes
+            else [
+                x.strip()
+                for x in os.environ.get("EXCHANGE_SHARED_INBOXES", "").split(
+                    ","
+                )
+            ]
+        )
+        exchange_incremental = (
+            incremental
+            if incremental is not None
+            else env_flag("EXCHANGE_INCREMENTAL_SYNC")
+        )
+
+        if not exchange_username or not exchange_password:
+            LOGGER.warning(
+                "Exchange username and password are required to fetch events"
+            )
+            return None
+
+        return {
+            "username": exchange_username,
+            "email": exchange_email,
+            "password": exchange_password,
+            "shared_inboxes": exchange_shared_inboxes,
+            "autodiscovery": exchange_autodiscovery,
+            "service_endpoint": exchange_service_endpoint,
+            "version": exchange_version,
+            "auth_type": exchange_auth_type,
+            "incremental": exchange_incremental,
+        }
+
+    async def fetch(
+        self, window, since_state=None, incremental=False, **settings
+    ):
+        LOGGER.info(
+            "Fetch calendar events from Exchange for user "
+            f"{settings['username']}"
+        )
+        sync_state = since_state if incremental else None
+        # Autodiscovery results, see exchange.get_account
+        connection_key = f"{self.name}{CACHE_KEY_CONNECTION_SUFFIX}"
+        connection_state = (
+            self.cache.get(connection_key, {})
+            if self.cache is not None
+            else {}
+        )
+        get_events = await _load("get_exchange_events")
+        events = await get_events(
+            **settings,
+            start=window[0],
+            end=window[1],
+            sync_state=sync_state,
+            connection_state=connection_state,
+        )
+        if self.cache is not None:
+            self.cache.set(connection_key, connection_state)
+        return events, sync_state
+
+
+class GoogleBackend(Backend):
+    incremental = True
+    projection = True
+
+    def settings(
+        self,
+        credentials: Optional[str] = None,
+        calendar_regex: Optional[str] = None,
+        incremental: Optional[bool] = None,
+    ):
+        google_credentials = (
+            credentials
+            if credentials
+            else os.environ.get("GOOGLE_CREDENTIALS")
+        )
+        google_calendar_regex = (
+            calendar_regex
+            if calendar_regex is not None
+            else os.environ.get("GOOGLE_CALENDAR_REGEX", "")
+        )
+        google_incremental = (
+            incremental
+            if incremental is not None
+            else env_flag("GOOGLE_INCREMENTAL_SYNC")
+        )
+
+        if not google_credentials:
+            LOGGER.warning("Google credentials are required to fetch events")
+            return None
+
+        return {
+            "credentials": google_credentials,
+            "calendar_regex": google_calendar_regex,
+            "incremental": google_incremental,
+        }
+
+    async def fetch(
+        self, window, since_state=None, incremental=False, **settings
+    ):
+        LOGGER.info("Fetching calendar events from google")
+        sync_state = since_state if incremental else None
+        get_events = await _load("get_google_events")
+        events = await get_events(
+            **settings,
+            start=window[0],
+            end=window[1],
+            sync_state=sync_state,
+        )
+        return events, sync_state
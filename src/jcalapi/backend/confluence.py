@@ -3,8 +3,12 @@
 
 import argparse
 import datetime
+import hashlib
 import logging
+import os
 import re
+import time
+from functools import partial
 
 import asyncio
 
@@ -16,10 +20,30 @@ from bs4 import BeautifulSoup
 from dateutil.parser import parse as dparse
 from dateutil.tz import gettz
 
-from jcalapi.events import guess_conference_location
+from jcalapi.events import (
+    FIELD_PROFILE,
+    guess_conference_location,
+    project_event,
+)
+from jcalapi.utils import LRUCache
 
 LOGGER = logging.getLogger(__name__)
 
+# Max number of sub-calendars downloaded concurrently
+MAX_CONNECTIONS = int(os.environ.get("CONFLUENCE_MAX_CONNECTIONS", 4))
+# For how long (in seconds) the list of sub-calendars is cached
+CALENDAR_INFO_TTL = int(os.environ.get("CONFLUENCE_CALENDAR_INFO_TTL", 3600))
+# {(url, username, password): (timestamp, calendar metadata)}
+CALENDAR_INFO = {}
+# Parsed events, keyed by the hash of the ICS payloads
+PARSE_CACHE = LRUCache(
+    maxsize=int(os.environ.get("CONFLUENCE_PARSE_CACHE_SIZE", 32))
+)
+# Expiry (in seconds) of the parsed events in the persistent cache
+PARSE_CACHE_EXPIRY = int(
+    os.environ.get("CONFLUENCE_PARSE_CACHE_EXPIRY", 60 * 60 * 24)
+)
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -56,6 +80,29 @@ def get_confluence_calendar_info(url: str, username: str, password: str):
     return cal_metadata
 
 
+async def get_calendar_info(url: str, username: str, password: str):
+    # Non-blocking, cached version of get_confluence_calendar_info.
+    # The list of sub-calendars rarely changes, no need to fetch it on
+    # every refresh.
+    key = (url, username, password)
+    cached = CALENDAR_INFO.get(key)
+    if cached and time.monotonic() - cached[0] < CALENDAR_INFO_TTL:
+        return cached[1]
+
+    # The Confluence client is synchronous, run it in a thread to not block
+    # the event loop
+    loop = asyncio.get_running_loop()
+    func = partial(
+        get_confluence_calendar_info,
+        url=url,
+        username=username,
+        password=password,
+    )
+    cal_metadata = await loop.run_in_executor(None, func)
+    CALENDAR_INFO[key] = (time.monotonic(), cal_metadata)
+    return cal_metadata
+
+
 def email_to_name(email: str):
     m = re.search(r"([^\.]+)\.([^.@]+)(?:\.ext)?@.+\..+", email)
     return (
@@ -70,8 +117,15 @@ async def get_confluence_events(
     convert_email=False,
     start=None,
     end=None,
+    sync_state=None,
+    max_connections=None,
+    parse_cache=None,
 ):
-    cal_metadata = get_confluence_calendar_info(url, username, password)
+    # NOTE sync_state (updated in place) holds the state of the last fetch of
+    # each sub-calendar, see fetch_calendar_events
+    # parse_cache is an optional persistent cache (eg: a diskcache.Cache)
+    # for the parsed events, see parse_calendar_events_cached
+    cal_metadata = await get_calendar_info(url, username, password)
 
     # If start is undefined, set it to next monday
     if not start:
@@ -83,163 +137,282 @@ async def get_confluence_events(
         end = start + datetime.timedelta(days=14)
     LOGGER.info(f"Searching for events between {start} and {end}")
 
-    events = []
-    # ics_raw = requests.get(ics_url, auth=(args.username, args.password)).text
+    if sync_state is None:
+        sync_state = {}
+    semaphore = asyncio.Semaphore(max_connections or MAX_CONNECTIONS)
     timeout = httpx.Timeout(10.0)
     async with httpx.AsyncClient(
         auth=(username, password), timeout=timeout
     ) as client:
-        for cal in cal_metadata:
-            try:
-                response = await client.get(cal["url"])
-                LOGGER.debug(
-                    f"Fetch {cal['name']} - http response: {response}"
-                )
-                response.raise_for_status()
-            except httpx.HTTPStatusError as exc:
-                LOGGER.error(
-                    f"Error response {exc.response.status_code} "
-                    f"while requesting {exc.request.url!r}."
+        results = await asyncio.gather(
+            *(
+                fetch_calendar_events(
+                    client,
+                    semaphore,
+                    cal,
+                    start=start,
+                    end=end,
+                    convert_email=convert_email,
+                    state=sync_state.setdefault(cal["id"], {}),
+                    parse_cache=parse_cache,
                 )
-                continue
-
-            ical = icalendar.Calendar.from_ical(response.text)
-            normal_events = []
-
-            # Get list of normal, non-recurring events
-            for item in ical.walk():
-                # Skip non-events
-                if item.name != "VEVENT":
-                    LOGGER.debug(
-                        f"Not an event ({item.name}). Skip this ical item."
-                    )
-                    continue
-                # TODO only add if in between start and end dates
-                normal_events.append(item)
-
-            # Recurring events
-            recurring_events = recurring_ical_events.of(ical).between(
-                start, end
+                for cal in cal_metadata
             )
+        )
 
-            for e in normal_events + recurring_events:
-                ev_recurring = e in recurring_events
-                ev_summary = (
-                    e.decoded("SUMMARY").decode("utf-8").strip()
-                    if "SUMMARY" in e
-                    else None
-                )
-                ev_start = e.decoded("DTSTART")
-                ev_end = e.decoded("DTEND")
-
-                # Parse date strings if the resulting object are strings
-                if isinstance(ev_start, str):
-                    ev_start = dparse(ev_start)
-                if isinstance(ev_end, str):
-                    ev_end = dparse(ev_end)
-
-                whole_day = False
-                # Convert date to datetime
-                if not isinstance(ev_start, datetime.datetime):
-                    whole_day = True
-                    ev_start = datetime.datetime.combine(
-                        ev_start,
-                        datetime.datetime.min.time(),
-                        tzinfo=gettz(cal["tz"]),
-                    )
-                    ev_start = ev_start.replace(microsecond=0)
-                if not isinstance(ev_end, datetime.datetime):
-                    ev_end = datetime.datetime.combine(
-                        ev_end,
-                        datetime.datetime.max.time(),
-                        tzinfo=gettz(cal["tz"]),
-                    )
-                    ev_end = ev_end.replace(microsecond=0)
-                ev_rrule = e.decoded("RRULE") if "RRULE" in e else None
-                if ev_rrule:
-                    LOGGER.info(
-                        f"Recurring event: {ev_summary} [{ev_start} - {ev_end}]"  # noqa: E501
-                        f"RRULE: {ev_rrule}. SKIP: Processing later."
-                    )
-                    continue
-                ev_uid = str(e.get("UID"))
-                ev_description = (
-                    BeautifulSoup(e.decoded("DESCRIPTION").decode("utf-8"))
-                    .get_text()
-                    .strip()
-                    if "DESCRIPTION" in e
-                    else ""
-                )
-                ev_organizer = (
-                    str(e.decoded("ORGANIZER")) if "ORGANIZER" in e else ""
-                )
-                ev_organizer = ev_organizer.removeprefix("mailto:")
-                if convert_email:
-                    ev_organizer = email_to_name(ev_organizer)
-
-                # attendees
-                ev_attendees = []
-                if "ATTENDEE" in e:
-                    att = e.decoded("ATTENDEE")
-                    email = "".join(att).removeprefix("mailto:")
-                    name = email_to_name(email)
-                    attendee = {
-                        "name": name,
-                        "email": email,
-                        # There is no optional attendees in Confluence
-                        "optional": False,
-                    }
-                    ev_attendees.append(attendee)
-
-                ev_location = (
-                    e.decoded("LOCATION").decode("utf-8")
-                    if "LOCATION" in e
-                    else None
-                )
-                ev_url = e.decoded("URL") if "URL" in e else None
-                ev_status = (
-                    e.decoded("STATUS").decode("utf-8").lower()
-                    if "STATUS" in e
-                    else "confirmed"
-                )
+    # Forget about calendars that are gone
+    for cal_id in set(sync_state) - {x["id"] for x in cal_metadata}:
+        del sync_state[cal_id]
+
+    # NOTE Duplicates are already skipped for each calendar
+    events = []
+    for cal_events in results:
+        events += cal_events
+
+    return events
+
+
+async def fetch_calendar_events(
+    client,
+    semaphore,
+    cal,
+    start,
+    end,
+    convert_email=False,
+    state=None,
+    parse_cache=None,
+):
+    # Download and parse the events of a single sub-calendar.
+    # state (updated in place) holds the HTTP validators (ETag and
+    # Last-Modified) of the last download along with the parsed events, so
+    # that unchanged calendars don't need to be downloaded and parsed again.
+    if state is None:
+        state = {}
+    headers = {}
+    params = (start, end, convert_email)
+    if state.get("params") == params:
+        if state.get("etag"):
+            headers["If-None-Match"] = state["etag"]
+        if state.get("last_modified"):
+            headers["If-Modified-Since"] = state["last_modified"]
+
+    # ics_raw = requests.get(ics_url, auth=(args.username, args.password)).text
+    async with semaphore:
+        try:
+            response = await client.get(cal["url"], headers=headers)
+            LOGGER.debug(f"Fetch {cal['name']} - http response: {response}")
+            if response.status_code == 304:
+                LOGGER.info(f"{cal['name']} has not changed since last fetch")
+                return state["events"]
+            response.raise_for_status()
+        except httpx.HTTPStatusError as exc:
+            LOGGER.error(
+                f"Error response {exc.response.status_code} "
+                f"while requesting {exc.request.url!r}."
+            )
+            return []
+
+    events = parse_calendar_events_cached(
+        response.content,
+        cal,
+        start,
+        end,
+        convert_email=convert_email,
+        cache=parse_cache,
+    )
+    state.clear()
+    state.update(
+        {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "params": params,
+            "events": events,
+        }
+    )
+    return events
 
-                LOGGER.debug(
-                    f"Processing: {ev_summary} [{ev_start} - {ev_end}]"
+
+def parse_calendar_events_cached(
+    ics, cal, start, end, convert_email=False, cache=None
+):
+    # Parsing and expanding the recurring events is expensive, the parsed
+    # events are cached by the hash of the ICS payload (and of everything
+    # else that affects the result). The cache is kept in memory and
+    # optionally in a persistent cache (anything with diskcache's get/set).
+    digest = hashlib.sha256(ics).hexdigest()
+    key = (
+        f"confluence-parse-{digest}-"
+        + hashlib.sha256(
+            repr(
+                (
+                    cal["id"],
+                    cal["name"],
+                    cal["tz"],
+                    start,
+                    end,
+                    convert_email,
+                    FIELD_PROFILE,
                 )
-                if not isinstance(ev_start, datetime.datetime):
-                    start = datetime.datetime.combine(
-                        start, datetime.time(0, 0)
-                    )
-                if not isinstance(ev_end, datetime.datetime):
-                    end = datetime.datetime.combine(end, datetime.time(23, 59))
-
-                # Save data
-                data = {
-                    "uid": ev_uid,
-                    "backend": "confluence",
-                    "calendar": cal["name"],
-                    "organizer": ev_organizer,
-                    "attendees": ev_attendees,
-                    "summary": ev_summary,
-                    "description": ev_description,
-                    "location": ev_location,
-                    "start": ev_start,
-                    "end": ev_end,
-                    "whole_day": whole_day,
-                    "is_recurring": ev_recurring,
-                    "status": ev_status,
-                    "extra": {"url": ev_url},
-                }
-                data["conference_url"] = guess_conference_location(data)
-
-                if data in events:
-                    LOGGER.warning(f"Duplicate item detected: {data}")
-                else:
-                    events.append(data)
+            ).encode()
+        ).hexdigest()
+    )
 
+    events = PARSE_CACHE.get(key)
+    if events is None and cache is not None:
+        events = cache.get(key)
+        if events is not None:
+            PARSE_CACHE.set(key, events)
+    if events is not None:
+        LOGGER.info(f"{cal['name']}: using cached events")
+        return events
+
+    events = parse_calendar_events(
+        ics.decode("utf-8"), cal, start, end, convert_email=convert_email
+    )
+    PARSE_CACHE.set(key, events)
+    if cache is not None:
+        cache.set(key, events, expire=PARSE_CACHE_EXPIRY)
     return events
 
 
+def parse_calendar_events(ics, cal, start, end, convert_email=False):
+    return list(
+        iter_calendar_events(ics, cal, start, end, convert_email=convert_email)
+    )
+
+
+def _text(component, prop):
+    # Decoded text value of a property
+    value = component.decoded(prop)
+    return value.decode("utf-8") if isinstance(value, bytes) else str(value)
+
+
+def iter_calendar_events(ics, cal, start, end, convert_email=False):
+    # Single pass over the calendar: non-recurring events are converted as
+    # they are found, the recurring ones are expanded over [start, end].
+    ical = icalendar.Calendar.from_ical(ics)
+    tz = gettz(cal["tz"])
+    recurring_uids = set()
+    # (UID, RECURRENCE-ID or DTSTART) of the events already processed
+    seen = set()
+
+    def convert(e, is_recurring):
+        data = convert_event(e, cal, tz, is_recurring, convert_email)
+        rid = e.get("RECURRENCE-ID")
+        key = (data.uid, rid.to_ical() if rid else data.start)
+        if key in seen:
+            LOGGER.warning(f"Duplicate item detected: {data}")
+            return None
+        seen.add(key)
+        return data
+
+    for e in ical.walk("VEVENT"):
+        # Recurring events (and their modified occurrences) are processed
+        # below
+        if "RRULE" in e or "RDATE" in e or "RECURRENCE-ID" in e:
+            recurring_uids.add(str(e.get("UID")))
+            continue
+        # TODO only add if in between start and end dates
+        data = convert(e, is_recurring=False)
+        if data is not None:
+            yield data
+
+    if not recurring_uids:
+        return
+
+    for e in recurring_ical_events.of(ical).between(start, end):
+        # Non-recurring events are part of the expansion too, but we already
+        # got these
+        if str(e.get("UID")) not in recurring_uids:
+            continue
+        data = convert(e, is_recurring=True)
+        if data is not None:
+            yield data
+
+
+def convert_event(e, cal, tz, is_recurring, convert_email=False):
+    ev_summary = _text(e, "SUMMARY").strip() if "SUMMARY" in e else None
+    ev_start = e.decoded("DTSTART")
+    ev_end = e.decoded("DTEND")
+
+    # Parse date strings if the resulting object are strings
+    if isinstance(ev_start, str):
+        ev_start = dparse(ev_start)
+    if isinstance(ev_end, str):
+        ev_end = dparse(ev_end)
+
+    whole_day = False
+    # Convert date to datetime
+    if not isinstance(ev_start, datetime.datetime):
+        whole_day = True
+        ev_start = datetime.datetime.combine(
+            ev_start,
+            datetime.datetime.min.time(),
+            tzinfo=tz,
+        )
+        ev_start = ev_start.replace(microsecond=0)
+    if not isinstance(ev_end, datetime.datetime):
+        ev_end = datetime.datetime.combine(
+            ev_end,
+            datetime.datetime.max.time(),
+            tzinfo=tz,
+        )
+        ev_end = ev_end.replace(microsecond=0)
+
+    ev_uid = str(e.get("UID"))
+    ev_description = (
+        BeautifulSoup(_text(e, "DESCRIPTION"), features="lxml")
+        .get_text()
+        .strip()
+        if "DESCRIPTION" in e
+        else ""
+    )
+    ev_organizer = str(e.decoded("ORGANIZER")) if "ORGANIZER" in e else ""
+    ev_organizer = ev_organizer.removeprefix("mailto:")
+    if convert_email:
+        ev_organizer = email_to_name(ev_organizer)
+
+    # attendees
+    ev_attendees = []
+    if "ATTENDEE" in e:
+        att = e.decoded("ATTENDEE")
+        email = "".join(att).removeprefix("mailto:")
+        name = email_to_name(email)
+        attendee = {
+            "name": name,
+            "email": email,
+            # There is no optional attendees in Confluence
+            "optional": False,
+        }
+        ev_attendees.append(attendee)
+
+    ev_location = _text(e, "LOCATION") if "LOCATION" in e else None
+    ev_url = e.decoded("URL") if "URL" in e else None
+    ev_status = _text(e, "STATUS").lower() if "STATUS" in e else "confirmed"
+
+    LOGGER.debug(f"Processing: {ev_summary} [{ev_start} - {ev_end}]")
+
+    # Save data
+    data = {
+        "uid": ev_uid,
+        "backend": "confluence",
+        "calendar": cal["name"],
+        "organizer": ev_organizer,
+        "attendees": ev_attendees,
+        "summary": ev_summary,
+        "description": ev_description,
+        "location": ev_location,
+        "start": ev_start,
+        "end": ev_end,
+        "whole_day": whole_day,
+        "is_recurring": is_recurring,
+        "status": ev_status,
+        "extra": {"url": ev_url},
+    }
+    data["conference_url"] = guess_conference_location(data)
+    return project_event(data)
+
+
 async def main():
     args = parse_args()
     logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
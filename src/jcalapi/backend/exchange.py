@@ -2,27 +2,90 @@
 
 import asyncio
 import datetime
+import hashlib
 import os
-import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 
-from bs4 import BeautifulSoup
 from exchangelib import (
     DELEGATE,
     Account,
     Configuration,
     Credentials,
+    Build,
     EWSDate,
     EWSTimeZone,
+    Version,
+)
+from exchangelib.errors import (
+    ErrorInvalidServerVersion,
+    ErrorInvalidSyncStateData,
+    ErrorSyncFolderNotFound,
+    TransportError,
+    UnauthorizedError,
 )
 from exchangelib.folders import Calendar, SingleFolderQuerySet
+from exchangelib.items.calendar_item import RECURRING_MASTER, SINGLE
 from exchangelib.properties import DistinguishedFolderId, Mailbox
+from exchangelib.services import SyncFolderItems
 
-from jcalapi.events import guess_conference_location
+from jcalapi.events import (
+    FIELD_PROFILE,
+    guess_conference_location,
+    project_event,
+)
+from jcalapi.responses import json_encode
+from jcalapi.utils import LRUCache, html_to_text
 
 LOGGER = logging.getLogger(__name__)
 
+# Errors after which the connection to the server gets set up again
+CONNECTION_ERRORS = (
+    ErrorInvalidServerVersion,
+    TransportError,
+    UnauthorizedError,
+)
+
+# Max number of calendars fetched concurrently
+MAX_WORKERS = int(os.environ.get("EXCHANGE_MAX_WORKERS", 4))
+
+# Whether to return the raw HTML body of the events (besides their text)
+INCLUDE_BODY = os.environ.get("EXCHANGE_INCLUDE_BODY", "true").lower() in [
+    "true",
+    "yes",
+    "1",
+]
+# Text and links of the HTML bodies, keyed by their hash
+BODY_CACHE = LRUCache(
+    maxsize=int(os.environ.get("EXCHANGE_BODY_CACHE_SIZE", 2048))
+)
+
+# Item fields to fetch for each field profile (None means all of them)
+# NOTE The body is required to find MS Teams links
+ONLY_FIELDS = {
+    "full": None,
+    "minimal": (
+        "uid",
+        "type",
+        "subject",
+        "start",
+        "end",
+        "location",
+        "is_cancelled",
+        "is_recurring",
+        "body",
+        "conference_type",
+        "meeting_workspace_url",
+        "net_show_url",
+    ),
+}.get(FIELD_PROFILE)
+
+# {(username, password, email, ...): Account}
+ACCOUNTS = {}
+# {(Account, shared inbox): Calendar}
+SHARED_CALENDARS = {}
+
 
 def parse_args():
     import argparse
@@ -53,6 +116,9 @@ async def get_exchange_events(
     version=None,
     start=None,
     end=None,
+    sync_state=None,
+    connection_state=None,
+    max_workers=None,
 ):
     # https://docs.python.org/3/library/asyncio-eventloop.html#asyncio.loop.run_in_executor
     loop = asyncio.get_running_loop()
@@ -68,6 +134,9 @@ async def get_exchange_events(
         version=version,
         start=start,
         end=end,
+        sync_state=sync_state,
+        connection_state=connection_state,
+        max_workers=max_workers,
     )
     return await loop.run_in_executor(None, func)
 
@@ -83,25 +152,266 @@ def sync_get_exchange_events(
     version=None,
     start=None,
     end=None,
+    sync_state=None,
+    connection_state=None,
+    max_workers=None,
 ):
+    # NOTE If sync_state is not None, calendars are synced incrementally and
+    # sync_state gets updated in place (it should be persisted by the
+    # caller and passed on the next call)
+    # connection_state (updated in place) holds the autodiscovered
+    # connection settings, so that autodiscovery can be skipped after a
+    # restart.
     email = email if email else username
+    account_params = dict(
+        username=username,
+        password=password,
+        email=email,
+        autodiscovery=autodiscovery,
+        service_endpoint=service_endpoint,
+        auth_type=auth_type,
+        version=version,
+    )
+    account = get_account(**account_params, connection_state=connection_state)
+    try:
+        return collect_events(
+            account,
+            username,
+            shared_inboxes,
+            start,
+            end,
+            sync_state,
+            max_workers=max_workers,
+        )
+    except CONNECTION_ERRORS as exc:
+        # The server (or our credentials) may have changed since the
+        # connection was set up: start from scratch (and autodiscover
+        # again if enabled)
+        LOGGER.warning(f"Exchange connection error, reconnecting: {exc}")
+        forget_account(**account_params, connection_state=connection_state)
+        account = get_account(
+            **account_params, connection_state=connection_state
+        )
+        return collect_events(
+            account,
+            username,
+            shared_inboxes,
+            start,
+            end,
+            sync_state,
+            max_workers=max_workers,
+        )
+
+
+def collect_events(
+    account,
+    username,
+    shared_inboxes,
+    start,
+    end,
+    sync_state,
+    max_workers=None,
+):
+    calendars = get_calendars(account, username, shared_inboxes)
+
+    today = datetime.datetime.today()
+    # tomorrow = today + datetime.timedelta(days=1)
+    midnight_today = datetime.datetime.combine(
+        today if not start else start,
+        datetime.datetime.min.time(),
+        tzinfo=account.default_timezone,
+    )
+    # midnight_tomorrow = datetime.datetime.combine(
+    #     tomorrow if not end else end,
+    #     datetime.datetime.min.time(),
+    #     tzinfo=account.default_timezone,
+    # )
+
+    if not start:
+        today = midnight_today  # datetime.date.today()
+        last_monday = today - datetime.timedelta(days=today.weekday())
+        start = last_monday
+    # For end, default to start + 14 days
+    if not end:
+        FUTURE_DAYS_IMPORT = int(os.environ.get("FUTURE_DAYS_IMPORT", 14))
+        end = start + datetime.timedelta(days=FUTURE_DAYS_IMPORT)
+
+    def process_calendar(cal, cal_name, state):
+        LOGGER.info(f"Processing calendar {cal_name}")
+        if state is not None:
+            return sync_calendar_events(
+                account, cal, cal_name, start, end, state=state
+            )
+        return fetch_calendar_events(cal, cal_name, start, end)
+
+    # Calendars are fetched concurrently, but with a bounded number of
+    # workers to stay within the EWS throttling limits
+    max_workers = max_workers or MAX_WORKERS
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(max_workers, len(calendars)))
+    ) as executor:
+        futures = [
+            executor.submit(
+                process_calendar,
+                cal,
+                cal_name,
+                (
+                    sync_state.setdefault(cal_name, {})
+                    if sync_state is not None
+                    else None
+                ),
+            )
+            for cal, cal_name in calendars
+        ]
+        # Keep the order of the calendars
+        data = []
+        for future in futures:
+            data += future.result()
+
+    if sync_state is not None:
+        # Forget about calendars that are not synced anymore
+        for cal_name in set(sync_state) - {x[1] for x in calendars}:
+            del sync_state[cal_name]
+
+    return data
+
+
+def _account_key(
+    username,
+    password,
+    email,
+    autodiscovery,
+    service_endpoint,
+    auth_type,
+    version,
+):
+    return (
+        username,
+        password,
+        email,
+        autodiscovery,
+        service_endpoint,
+        auth_type,
+        version,
+    )
+
+
+def get_account(
+    username,
+    password,
+    email,
+    autodiscovery=True,
+    service_endpoint=None,
+    auth_type="NTLM",
+    version=None,
+    connection_state=None,
+):
+    # Accounts are kept around (along with their connection pool and
+    # resolved folders) and reused across refreshes
+    key = _account_key(
+        username,
+        password,
+        email,
+        autodiscovery,
+        service_endpoint,
+        auth_type,
+        version,
+    )
+    account = ACCOUNTS.get(key)
+    if account is not None:
+        return account
+
     credentials = Credentials(username, password)
-    if autodiscovery:
+    discovered = (
+        connection_state.get(email)
+        if autodiscovery and connection_state
+        else None
+    )
+    if discovered:
+        LOGGER.info(
+            f"Using previously discovered EWS endpoint for {email}: "
+            f"{discovered['service_endpoint']}"
+        )
+        config = Configuration(
+            service_endpoint=discovered["service_endpoint"],
+            credentials=credentials,
+            auth_type=discovered["auth_type"],
+            version=Version(
+                build=Build(*discovered["build"]),
+                api_version=discovered["api_version"],
+            ),
+        )
+        account = Account(
+            primary_smtp_address=email,
+            config=config,
+            autodiscover=False,
+            access_type=DELEGATE,
+        )
+    elif autodiscovery:
         account = Account(email, credentials=credentials, autodiscover=True)
+        if connection_state is not None:
+            build = account.version.build
+            connection_state[email] = {
+                "service_endpoint": account.protocol.service_endpoint,
+                "auth_type": account.protocol.auth_type,
+                "build": [
+                    build.major_version,
+                    build.minor_version,
+                    build.major_build,
+                    build.minor_build,
+                ],
+                "api_version": account.version.api_version,
+            }
     else:
         config = Configuration(
             service_endpoint=service_endpoint,
             credentials=credentials,
             auth_type=auth_type,
             version=version,
-            # FIXME Version should ideally be passed in a string, which we then
-            # need to parse and convert to Version/Build objects
+            # FIXME Version should ideally be passed in a string, which we
+            # then need to parse and convert to Version/Build objects
             # Example:
             # version=Version(Build(15, 1, 2507, 16), "Exchange2016"),
         )
         account = Account(
             primary_smtp_address=email, config=config, access_type=DELEGATE
         )
+
+    ACCOUNTS[key] = account
+    return account
+
+
+def forget_account(
+    username,
+    password,
+    email,
+    autodiscovery=True,
+    service_endpoint=None,
+    auth_type="NTLM",
+    version=None,
+    connection_state=None,
+):
+    account = ACCOUNTS.pop(
+        _account_key(
+            username,
+            password,
+            email,
+            autodiscovery,
+            service_endpoint,
+            auth_type,
+            version,
+        ),
+        None,
+    )
+    if account is not None:
+        for key in [x for x in SHARED_CALENDARS if x[0] is account]:
+            del SHARED_CALENDARS[key]
+    if connection_state:
+        connection_state.pop(email, None)
+
+
+def get_calendars(account, username, shared_inboxes=[]):
+    # Returns a list of (calendar, calendar name) tuples
     # FIXME Below used to work in earlier versions of exchangelib, but now it
     # yeilds
     # ErrorAccessDenied: Access is denied. Check credentials and try again.,
@@ -109,13 +419,18 @@ def sync_get_exchange_events(
     # calendars = [
     #     x for x in account.calendar.children if isinstance(x, Calendar)
     # ] + [account.calendar]
-    calendars = [account.calendar]
+    calendars = [(account.calendar, f"{account.calendar.name} ({username})")]
 
-    shared_calendars = {}
     for shared_inbox in shared_inboxes:
         if not shared_inbox:
             # Skip if empty
             continue
+        shared_calendar = SHARED_CALENDARS.get((account, shared_inbox))
+        if shared_calendar is not None:
+            calendars.append(
+                (shared_calendar, f"{shared_calendar.name} ({shared_inbox})")
+            )
+            continue
         try:
             shared_calendar = SingleFolderQuerySet(
                 account=account,
@@ -124,139 +439,246 @@ def sync_get_exchange_events(
                     mailbox=Mailbox(email_address=shared_inbox),
                 ),
             ).resolve()
-            shared_calendars[shared_calendar] = shared_inbox
-            calendars.append(shared_calendar)
+            SHARED_CALENDARS[(account, shared_inbox)] = shared_calendar
+            calendars.append(
+                (shared_calendar, f"{shared_calendar.name} ({shared_inbox})")
+            )
         except ValueError as e:
             LOGGER.warning(f"Could not find calendar for {shared_inbox}: {e}")
 
-    today = datetime.datetime.today()
-    # tomorrow = today + datetime.timedelta(days=1)
-    midnight_today = datetime.datetime.combine(
-        today if not start else start,
-        datetime.datetime.min.time(),
-        tzinfo=account.default_timezone,
+    return calendars
+
+
+def calendar_view(cal, start, end):
+    qs = cal.view(start, end)
+    return qs.only(*ONLY_FIELDS) if ONLY_FIELDS else qs
+
+
+def fetch_calendar_events(cal, cal_name, start, end):
+    # for ev in cal.all().filter(start__range=(start, end)):
+    return [
+        convert_event(ev, cal_name) for ev in calendar_view(cal, start, end)
+    ]
+
+
+def sync_calendar_events(account, cal, cal_name, start, end, state):
+    # Incremental sync of a single calendar, using SyncFolderItems.
+    # state (updated in place) holds the EWS sync state, the synced window
+    # and the converted events:
+    # - singles: {item_id: event} for non-recurring items
+    # - recurring: [event, ...] for the occurrences of recurring items
+    # NOTE SyncFolderItems reports changes to recurring items (including
+    # modified or deleted occurrences) on their master item, in which case
+    # the occurrences get expanded again with a CalendarView.
+    # When the window slides forward only the newly uncovered days get
+    # fetched, a full sync is required if it got extended into the past.
+    full = not state.get("sync_state") or start < state["start"]
+    if not full:
+        try:
+            _incremental_sync(account, cal, cal_name, start, end, state)
+        except (ErrorInvalidSyncStateData, ErrorSyncFolderNotFound) as exc:
+            # eg: the sync state expired, start over
+            LOGGER.warning(f"{cal_name}: invalid sync state ({exc})")
+            state.clear()
+            full = True
+    if full:
+        _full_sync(cal, cal_name, start, end, state)
+
+    return sorted(
+        [
+            x
+            for x in list(state["singles"].values()) + state["recurring"]
+            if x.end >= start and x.start < end
+        ],
+        key=lambda x: x.start,
     )
-    # midnight_tomorrow = datetime.datetime.combine(
-    #     tomorrow if not end else end,
-    #     datetime.datetime.min.time(),
-    #     tzinfo=account.default_timezone,
-    # )
 
-    if not start:
-        today = midnight_today  # datetime.date.today()
-        last_monday = today - datetime.timedelta(days=today.weekday())
-        start = last_monday
-    # For end, default to start + 14 days
-    if not end:
-        FUTURE_DAYS_IMPORT = int(os.environ.get("FUTURE_DAYS_IMPORT", 14))
-        end = start + datetime.timedelta(days=FUTURE_DAYS_IMPORT)
 
-    data = []
-    events = []
-    for cal in calendars:
-        if cal in shared_calendars:
-            cal_name = f"{cal.name} ({shared_calendars[cal]})"
+def _full_sync(cal, cal_name, start, end, state):
+    LOGGER.info(f"{cal_name}: full sync")
+    # Get the sync state first, so that changes happening while we
+    # fetch the events are picked up on the next sync. The folder objects
+    # are cached (see get_calendars): make sure that exchangelib doesn't
+    # start from their previous sync state.
+    cal.item_sync_state = None
+    for _ in cal.sync_items(only_fields=["type"]):
+        pass
+    state["sync_state"] = cal.item_sync_state
+    state["start"], state["end"] = start, end
+    state["singles"] = {}
+    state["recurring"] = []
+    for ev in calendar_view(cal, start, end):
+        if ev.type == SINGLE:
+            state["singles"][ev.id] = convert_event(ev, cal_name)
         else:
-            cal_name = f"{cal.name} ({username})"
+            state["recurring"].append(convert_event(ev, cal_name))
 
-        LOGGER.info(f"Processing calendar {cal_name}")
-        # for ev in cal.all().filter(start__range=(start, end)):
-        for ev in cal.view(start, end):
-            events.append(ev)
-
-            whole_day = False
-            if isinstance(ev.start, EWSDate):
-                whole_day = True
-                # Raw date objects
-                # ev_start = ev.start
-                # ev_end = ev.end
-                # Convert EWSDate objects to datetime
-                # ev_start = datetime.fromisoformat(ev.start.isoformat())
-                # ev_end = datetime.fromisoformat(ev.end.isoformat())
-                # Convert EWSDate to tz aware datetime objects
-                ev_start = datetime.datetime.combine(
-                    ev.start,
-                    datetime.datetime.min.time(),
-                    tzinfo=EWSTimeZone.localzone(),
-                )
-                ev_start = ev_start.replace(microsecond=0)
-                ev_end = datetime.datetime.combine(
-                    ev.end,
-                    datetime.datetime.max.time(),
-                    tzinfo=EWSTimeZone.localzone(),
-                )
-                ev_end = ev_end.replace(microsecond=0)
+
+def _incremental_sync(account, cal, cal_name, start, end, state):
+    if end > state["end"]:
+        LOGGER.info(f"{cal_name}: fetching {state['end']} - {end}")
+        for ev in calendar_view(cal, state["end"], end):
+            ev_data = convert_event(ev, cal_name)
+            if ev_data.start < state["end"]:
+                # Already part of the previous window
+                continue
+            if ev.type == SINGLE:
+                state["singles"][ev.id] = ev_data
             else:
-                # datetime object -> convert to local timezone
-                ev_start = ev.start.astimezone(EWSTimeZone.localzone())
-                ev_end = ev.end.astimezone(EWSTimeZone.localzone())
-
-            soup = BeautifulSoup(ev.body if ev.body else "", features="lxml")
-            ev_body = soup.get_text().strip() if ev.body else ""
-            ms_teams_urls = [
-                x.get("href")
-                for x in soup.find_all("a")
-                if "/meetup-join" in x.get("href", "")
-            ]
-            ms_teams_url = ms_teams_urls[0] if len(ms_teams_urls) > 0 else None
-            location = (
-                ms_teams_url
-                if (
-                    not ev.location
-                    or ev.location.startswith("Microsoft Teams")
-                )
-                else ev.location
-            )
+                state["recurring"].append(ev_data)
+        state["end"] = end
+    if start > state["start"]:
+        # Evict the events that fell off the window
+        state["singles"] = {
+            k: v for k, v in state["singles"].items() if v.end >= start
+        }
+        state["recurring"] = [x for x in state["recurring"] if x.end >= start]
+        state["start"] = start
 
-            ev_status = "cancelled" if ev.is_cancelled else "confirmed"
+    singles = state["singles"]
+    changed = []
+    expand = False
+    for change_type, item in cal.sync_items(
+        sync_state=state["sync_state"], only_fields=["type"]
+    ):
+        if change_type == SyncFolderItems.READ_FLAG_CHANGE:
+            continue
+        if change_type == SyncFolderItems.DELETE:
+            # We don't know the type of deleted items, if it's not a
+            # known single item it may be a recurring one
+            if singles.pop(item.id, None) is None:
+                expand = True
+        elif getattr(item, "type", None) == RECURRING_MASTER:
+            expand = True
+        elif getattr(item, "type", None) == SINGLE:
+            changed.append(item)
+    LOGGER.info(
+        f"{cal_name}: {len(changed)} changed items"
+        + (", recurring items changed" if expand else "")
+    )
 
-            ev_attendees = []
-            ev_optional_attendees = (
-                ev.optional_attendees if ev.optional_attendees else []
-            )
-            ev_required_attendees = (
-                ev.required_attendees if ev.required_attendees else []
+    fetched = (
+        account.fetch(ids=changed, only_fields=ONLY_FIELDS) if changed else []
+    )
+    for ev in fetched:
+        if isinstance(ev, Exception):
+            LOGGER.warning(f"{cal_name}: could not fetch item: {ev}")
+            continue
+        ev_data = convert_event(ev, cal_name)
+        if ev_data.end >= start and ev_data.start < end:
+            singles[ev.id] = ev_data
+        else:
+            singles.pop(ev.id, None)
+
+    if expand:
+        state["recurring"] = [
+            convert_event(ev, cal_name)
+            for ev in calendar_view(cal, start, end)
+            if ev.type != SINGLE
+        ]
+    state["sync_state"] = cal.item_sync_state
+
+
+def convert_event(ev, cal_name):
+    whole_day = False
+    if isinstance(ev.start, EWSDate):
+        whole_day = True
+        # Raw date objects
+        # ev_start = ev.start
+        # ev_end = ev.end
+        # Convert EWSDate objects to datetime
+        # ev_start = datetime.fromisoformat(ev.start.isoformat())
+        # ev_end = datetime.fromisoformat(ev.end.isoformat())
+        # Convert EWSDate to tz aware datetime objects
+        ev_start = datetime.datetime.combine(
+            ev.start,
+            datetime.datetime.min.time(),
+            tzinfo=EWSTimeZone.localzone(),
+        )
+        ev_start = ev_start.replace(microsecond=0)
+        ev_end = datetime.datetime.combine(
+            ev.end,
+            datetime.datetime.max.time(),
+            tzinfo=EWSTimeZone.localzone(),
+        )
+        ev_end = ev_end.replace(microsecond=0)
+    else:
+        # datetime object -> convert to local timezone
+        ev_start = ev.start.astimezone(EWSTimeZone.localzone())
+        ev_end = ev.end.astimezone(EWSTimeZone.localzone())
+
+    ev_body, links = parse_body(ev.body)
+    ms_teams_urls = [x for x in links if "/meetup-join" in x]
+    ms_teams_url = ms_teams_urls[0] if len(ms_teams_urls) > 0 else None
+    location = (
+        ms_teams_url
+        if (not ev.location or ev.location.startswith("Microsoft Teams"))
+        else ev.location
+    )
+
+    ev_status = "cancelled" if ev.is_cancelled else "confirmed"
+
+    ev_attendees = []
+    ev_optional_attendees = (
+        ev.optional_attendees if ev.optional_attendees else []
+    )
+    ev_required_attendees = (
+        ev.required_attendees if ev.required_attendees else []
+    )
+    for attendee_list in [
+        ev_required_attendees,
+        ev_optional_attendees,
+    ]:
+        for attendee in attendee_list:
+            ev_attendees.append(
+                {
+                    "name": attendee.mailbox.name,
+                    "email": attendee.mailbox.email_address,
+                    "optional": attendee in ev_optional_attendees,
+                    "response": attendee.response_type,
+                }
             )
-            for attendee_list in [
-                ev_required_attendees,
-                ev_optional_attendees,
-            ]:
-                for attendee in attendee_list:
-                    ev_attendees.append(
-                        {
-                            "name": attendee.mailbox.name,
-                            "email": attendee.mailbox.email_address,
-                            "optional": attendee in ev_optional_attendees,
-                            "response": attendee.response_type,
-                        }
-                    )
-
-            ev_data = {
-                "uid": ev.uid,
-                "backend": "exchange",
-                "calendar": cal_name,
-                "organizer": ev.organizer.name,
-                "attendees": ev_attendees,
-                "summary": ev.subject,
-                "description": ev_body,
-                "body": ev.body,
-                "location": location,
-                "start": ev_start,
-                "end": ev_end,
-                "whole_day": whole_day,
-                "is_recurring": ev.is_recurring,
-                "status": ev_status,
-                "categories": ev.categories,
-                "extra": {
-                    "conference_type": ev.conference_type,
-                    "meeting_workspace_url": ev.meeting_workspace_url,
-                    "net_show_url": ev.net_show_url,
-                },
-            }
-            ev_data["conference_url"] = guess_conference_location(ev_data)
-            data.append(ev_data)
 
-    return data
+    ev_data = {
+        "uid": ev.uid,
+        "backend": "exchange",
+        "calendar": cal_name,
+        "organizer": ev.organizer.name if ev.organizer else None,
+        "attendees": ev_attendees,
+        "summary": ev.subject,
+        "description": ev_body,
+        "body": ev.body if INCLUDE_BODY else None,
+        "location": location,
+        "start": ev_start,
+        "end": ev_end,
+        "whole_day": whole_day,
+        "is_recurring": ev.is_recurring,
+        "status": ev_status,
+        "categories": ev.categories,
+        "extra": {
+            "conference_type": ev.conference_type,
+            "meeting_workspace_url": ev.meeting_workspace_url,
+            "net_show_url": ev.net_show_url,
+        },
+    }
+    ev_data["conference_url"] = guess_conference_location(
+        ev_data, revision=(ev.id, ev.changekey) if ev.changekey else None
+    )
+    return project_event(ev_data)
+
+
+def parse_body(body):
+    # Returns the text and links of an HTML body. Bodies rarely change
+    # between two refreshes, hence the memoization (by hash).
+    if not body:
+        return "", []
+    key = hashlib.blake2b(body.encode("utf-8"), digest_size=16).digest()
+    res = BODY_CACHE.get(key)
+    if res is None:
+        text, links = html_to_text(body)
+        res = (text.strip(), links)
+        BODY_CACHE.set(key, res)
+    return res
 
 
 async def async_main():
@@ -269,7 +691,7 @@ async def async_main():
         start=None,
         end=None,
     )
-    print(json.dumps(data, default=str))
+    print(json_encode(data).decode())
 
 
 if __name__ == "__main__":
@@ -2,19 +2,45 @@
 
 import asyncio
 import datetime
-import json
 import logging
 import os
 import re
+import threading
 from functools import partial
 
 import tzlocal
+from gcsa.conference import ConferenceSolution, ConferenceSolutionCreateRequest
 from gcsa.google_calendar import GoogleCalendar
+from gcsa.serializers.conference_serializer import (
+    ConferenceSolutionCreateRequestSerializer,
+    ConferenceSolutionSerializer,
+)
+from gcsa.serializers.event_serializer import EventSerializer
+from googleapiclient.errors import HttpError
 
-from jcalapi.events import guess_conference_location
+from jcalapi.events import (
+    FIELD_PROFILE,
+    guess_conference_location,
+    project_event,
+)
+from jcalapi.responses import json_encode
 
 LOGGER = logging.getLogger(__name__)
 
+# Partial response mask for each field profile (None means all fields)
+FIELDS = {
+    "full": None,
+    "minimal": (
+        "items(id,etag,status,summary,location,description,start,end,"
+        "recurringEventId,conferenceData,hangoutLink,htmlLink),"
+        "nextPageToken,nextSyncToken"
+    ),
+}.get(FIELD_PROFILE)
+
+# The clients (httplib2) are not thread-safe, and the syncs run in executor
+# threads: one set of clients per thread, {credentials_path: GoogleCalendar}
+_THREAD_LOCAL = threading.local()
+
 
 def parse_args():
     import argparse
@@ -41,6 +67,7 @@ async def get_google_events(
     calendar_regex="",
     start=None,
     end=None,
+    sync_state=None,
 ):
     # https://docs.python.org/3/library/asyncio-eventloop.html#asyncio.loop.run_in_executor
     loop = asyncio.get_running_loop()
@@ -50,17 +77,35 @@ async def get_google_events(
         calendar_regex=calendar_regex,
         start=start,
         end=end,
+        sync_state=sync_state,
     )
     return await loop.run_in_executor(None, func)
 
 
+def get_client(credentials):
+    # Reuse the same client (and its authenticated session) across the syncs
+    # running in the same thread
+    clients = getattr(_THREAD_LOCAL, "clients", None)
+    if clients is None:
+        clients = _THREAD_LOCAL.clients = {}
+    gcal = clients.get(credentials)
+    if gcal is None:
+        gcal = GoogleCalendar(credentials_path=credentials, read_only=True)
+        clients[credentials] = gcal
+    return gcal
+
+
 def sync_get_google_events(
     credentials,
     calendar_regex="",
     start=None,
     end=None,
+    sync_state=None,
 ):
-    gcal = GoogleCalendar(credentials_path=credentials, read_only=True)
+    # NOTE If sync_state is not None, calendars are synced incrementally and
+    # sync_state gets updated in place (it should be persisted by the
+    # caller and passed on the next call)
+    gcal = get_client(credentials)
     pattern = calendar_regex or ""
     calendars = (
         [
@@ -107,6 +152,16 @@ def sync_get_google_events(
         calendar_id = cal.calendar_id
         LOGGER.info(f"Processing calendar {calendar_name} ({calendar_id})")
         LOGGER.info(f"Start: {start}, End: {end}")
+        if sync_state is not None:
+            data += sync_calendar(
+                gcal.service,
+                calendar_id=calendar_id,
+                calendar_name=calendar_name,
+                start=start,
+                end=end,
+                state=sync_state.setdefault(calendar_id, {}),
+            )
+            continue
         for ev in gcal.get_events(
             calendar_id=calendar_id,
             time_min=start,
@@ -114,72 +169,203 @@ def sync_get_google_events(
             order_by="startTime",
             single_events=True,  # expand recurring events
             timezone=local_tz_name,
+            **({"fields": FIELDS} if FIELDS else {}),
         ):
-            whole_day = False
-
-            # Convert to datetime if start/end props are date objects
-            ev_start = ev.start
-            if isinstance(ev_start, datetime.date) and not isinstance(
-                ev_start, datetime.datetime
-            ):
-                ev_start = datetime.datetime.combine(
-                    ev_start, datetime.time.min
-                ).astimezone(local_tz)
-                whole_day = True
-            else:
-                ev_start = ev_start.astimezone(local_tz)
-
-            ev_end = ev.end
-            if isinstance(ev_end, datetime.date) and not isinstance(
-                ev_end, datetime.datetime
-            ):
-                # Google uses an exclusive end date for all-day events, so
-                # shift back one day and use the end of that day.
-                ev_end = ev_end - datetime.timedelta(days=1)
-                ev_end = datetime.datetime.combine(
-                    ev_end, datetime.time.max
-                ).astimezone(local_tz)
-                whole_day = True
-            else:
-                ev_end = ev_end.astimezone(local_tz)
-
-            location = guess_conference_location(
-                {
-                    "location": ev.location,
-                    "description": ev.description,
-                    "extra": ev.other,
-                }
-            )
+            data.append(convert_event(ev, calendar_name))
 
-            ev_data = {
-                "uid": ev.event_id,
-                "backend": "google",
-                "calendar": calendar_name,
-                "organizer": (
-                    ev.organizer.display_name if ev.organizer else None
-                ),
-                "attendees": ev.attendees,
-                "summary": ev.summary,
-                "description": (
-                    None if ev.description == "\n" else ev.description
-                ),
-                "location": location,
-                "start": ev_start,
-                "end": ev_end,
-                "whole_day": whole_day,
-                "is_recurring": ev.is_recurring_instance,
-                "status": ev.other.get("status"),
-                "categories": None,  # TODO
-                "extra": {
-                    "conference_solution": ev.conference_solution,
-                    "link": ev.other.get("htmlLink"),
-                },
-            }
-            data.append(ev_data)
+    if sync_state is not None:
+        # Forget about calendars that are not synced anymore
+        for calendar_id in set(sync_state) - {
+            x.calendar_id for x in calendars
+        }:
+            del sync_state[calendar_id]
 
     return data
 
 
+def list_events(service, calendar_id, **params):
+    # Fetch all the pages of an events.list query, returns the raw event
+    # resources along with the sync token to use for the next sync
+    items = []
+    page_token = None
+    while True:
+        res = (
+            service.events()
+            .list(calendarId=calendar_id, pageToken=page_token, **params)
+            .execute()
+        )
+        items += res.get("items", [])
+        page_token = res.get("nextPageToken")
+        if not page_token:
+            return items, res.get("nextSyncToken")
+
+
+def sync_calendar(service, calendar_id, calendar_name, start, end, state):
+    # Incremental sync of a single calendar.
+    # state (updated in place) holds the sync token, the synced window and
+    # the converted events, keyed by event ID:
+    # {"token": str, "start": datetime, "end": datetime,
+    #  "events": {id: event}}
+    # NOTE service only needs to implement events().list().execute(), which
+    # makes it easy to substitute with a fake of the Calendar API.
+    params = {
+        "singleEvents": True,  # expand recurring events
+        "timeZone": tzlocal.get_localzone_name(),
+    }
+    if FIELDS:
+        params["fields"] = FIELDS
+    items = None
+
+    # Sync tokens can't be combined with timeMin/timeMax, changes outside
+    # of the window are filtered out below. When the window slides forward
+    # only the newly uncovered days get fetched, a full sync is required if
+    # it got extended into the past.
+    if (
+        state.get("token")
+        and state.get("start")
+        and state.get("end")
+        and start >= state["start"]
+    ):
+        try:
+            items, token = list_events(
+                service, calendar_id, syncToken=state["token"], **params
+            )
+            LOGGER.info(f"{calendar_name}: {len(items)} changed events")
+        except HttpError as exc:
+            if exc.resp.status != 410:
+                raise
+            LOGGER.warning(
+                f"{calendar_name}: sync token is no longer valid, "
+                "a full sync is required"
+            )
+
+    if items is None:
+        LOGGER.info(f"{calendar_name}: full sync")
+        items, token = list_events(
+            service,
+            calendar_id,
+            timeMin=start.isoformat(),
+            timeMax=end.isoformat(),
+            **params,
+        )
+        state["events"] = {}
+        state["start"], state["end"] = start, end
+    elif end > state["end"]:
+        LOGGER.info(f"{calendar_name}: fetching {state['end']} - {end}")
+        # The sync token obtained with the full sync is kept, it covers
+        # the changes to any event
+        items += list_events(
+            service,
+            calendar_id,
+            timeMin=state["end"].isoformat(),
+            timeMax=end.isoformat(),
+            **params,
+        )[0]
+        state["end"] = end
+
+    events = state["events"]
+    if start > state["start"]:
+        # Evict the events that fell off the window
+        for event_id in [k for k, v in events.items() if v.end < start]:
+            del events[event_id]
+        state["start"] = start
+    for item in items:
+        if item.get("status") == "cancelled":
+            events.pop(item["id"], None)
+            continue
+        ev = convert_event(EventSerializer.to_object(item), calendar_name)
+        if ev.end >= start and ev.start < end:
+            events[item["id"]] = ev
+        else:
+            events.pop(item["id"], None)
+    state["token"] = token
+
+    return sorted(
+        [x for x in events.values() if x.end >= start and x.start < end],
+        key=lambda x: x.start,
+    )
+
+
+def conference_data(solution):
+    # Plain conferenceData (as returned by the API) of gcsa's objects
+    if isinstance(solution, ConferenceSolution):
+        return ConferenceSolutionSerializer.to_json(solution)
+    if isinstance(solution, ConferenceSolutionCreateRequest):
+        return ConferenceSolutionCreateRequestSerializer.to_json(solution)
+    return None
+
+
+def convert_event(ev, calendar_name):
+    local_tz = tzlocal.get_localzone()
+    whole_day = False
+
+    # Convert to datetime if start/end props are date objects
+    ev_start = ev.start
+    if isinstance(ev_start, datetime.date) and not isinstance(
+        ev_start, datetime.datetime
+    ):
+        ev_start = datetime.datetime.combine(
+            ev_start, datetime.time.min
+        ).astimezone(local_tz)
+        whole_day = True
+    else:
+        ev_start = ev_start.astimezone(local_tz)
+
+    ev_end = ev.end
+    if isinstance(ev_end, datetime.date) and not isinstance(
+        ev_end, datetime.datetime
+    ):
+        # Google uses an exclusive end date for all-day events, so
+        # shift back one day and use the end of that day.
+        ev_end = ev_end - datetime.timedelta(days=1)
+        ev_end = datetime.datetime.combine(
+            ev_end, datetime.time.max
+        ).astimezone(local_tz)
+        whole_day = True
+    else:
+        ev_end = ev_end.astimezone(local_tz)
+
+    etag = ev.other.get("etag")
+    location = guess_conference_location(
+        {
+            "location": ev.location,
+            "description": ev.description,
+            "extra": ev.other,
+        },
+        revision=(ev.event_id, etag) if etag else None,
+    )
+
+    ev_data = {
+        "uid": ev.event_id,
+        "backend": "google",
+        "calendar": calendar_name,
+        "organizer": (ev.organizer.display_name if ev.organizer else None),
+        "attendees": [
+            {
+                "name": x.display_name,
+                "email": x.email,
+                "optional": bool(x.optional),
+                "response": x.response_status,
+            }
+            for x in ev.attendees
+        ],
+        "summary": ev.summary,
+        "description": (None if ev.description == "\n" else ev.description),
+        "location": location,
+        "start": ev_start,
+        "end": ev_end,
+        "whole_day": whole_day,
+        "is_recurring": ev.is_recurring_instance,
+        "status": ev.other.get("status"),
+        "categories": None,  # TODO
+        "extra": {
+            "conference_solution": conference_data(ev.conference_solution),
+            "link": ev.other.get("htmlLink"),
+        },
+    }
+    return project_event(ev_data)
+
+
 async def async_main():
     args = parse_args()
     logging.basicConfig(level=logging.INFO)
@@ -189,7 +375,7 @@ async def async_main():
         start=None,
         end=None,
     )
-    print(json.dumps(data, default=str))
+    print(json_encode(data).decode())
 
 
 if __name__ == "__main__":
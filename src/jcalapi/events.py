@@ -1,6 +1,39 @@
 # coding: utf-8
 
+import dataclasses
+import datetime
+import os
 import re
+import sys
+import zlib
+from collections.abc import Mapping
+from typing import Optional
+
+import tzlocal
+from dateutil.parser import parse as dparse
+
+from jcalapi.utils import LRUCache
+
+LOCAL_TZ = tzlocal.get_localzone()
+
+# Fields of the events for each field profile (None means all of them).
+# Backends only fetch what the selected profile needs when they can.
+FIELD_PROFILES = {
+    "full": None,
+    "minimal": (
+        "uid",
+        "backend",
+        "calendar",
+        "summary",
+        "location",
+        "start",
+        "end",
+        "whole_day",
+        "status",
+        "conference_url",
+    ),
+}
+FIELD_PROFILE = os.environ.get("FIELD_PROFILE", "full").lower()
 
 # FIXME This regex may be too greedy
 REGEX_ZOOM_URL = re.compile(r'(?P<url>https://[^/]*zoom.us/j/[^\s"]+)')
@@ -9,21 +42,250 @@ REGEX_MS_TEAMS_URL = re.compile(
     r'(?P<url>https://teams.microsoft.com/l/meetup-join[^"\s+]+)'
 )
 
+# Conference providers: {name: (hint, regex)}
+# The hint is a plain substring that any matching URL contains, it is used
+# to skip the regex search for the (many) fields without any conference URL.
+# NOTE The regexes match the URLs without their https:// prefix: having a
+# literal prefix common to all the alternatives makes the search much faster.
+CONFERENCE_PROVIDERS = {}
+# Alternation of all the provider regexes (one named group per provider)
+_CONFERENCE_REGEX = None
+# {revision: conference URL}
+CONFERENCE_CACHE = LRUCache(maxsize=4096)
+
+
+def register_conference_provider(name, hint, regex):
+    """
+    Register a conference provider.
+    name must be a valid identifier and regex must match the URLs without
+    their https:// prefix (and must not contain any named group)
+    """
+    global _CONFERENCE_REGEX
+    CONFERENCE_PROVIDERS[name] = (hint, regex)
+    _CONFERENCE_REGEX = None
+    CONFERENCE_CACHE.clear()
+
+
+def _conference_regex():
+    global _CONFERENCE_REGEX
+    if _CONFERENCE_REGEX is None:
+        _CONFERENCE_REGEX = re.compile(
+            "https://(?:"
+            + "|".join(
+                f"(?P<{name}>{regex})"
+                for name, (_, regex) in CONFERENCE_PROVIDERS.items()
+            )
+            + ")"
+        )
+    return _CONFERENCE_REGEX
+
+
+register_conference_provider("zoom", "zoom.us/j/", r'[^/]*zoom.us/j/[^\s"]+')
+register_conference_provider(
+    "ms_teams",
+    "teams.microsoft.com/l/meetup-join",
+    r'teams.microsoft.com/l/meetup-join[^"\s+]+',
+)
+register_conference_provider(
+    "google_meet",
+    "meet.google.com/",
+    r"meet\.google\.com/[a-z]{3}-[a-z]{4}-[a-z]{3}",
+)
+register_conference_provider(
+    "webex",
+    "webex.com/",
+    r'[\w.-]+\.webex\.com/(?:meet/|join/|[\w.-]+/j\.php)[^\s"<>]*',
+)
+register_conference_provider(
+    "jitsi", "meet.jit.si/", r'meet\.jit\.si/[^\s"<>]+'
+)
+
+
+def find_conference_url(text):
+    # First conference URL in text (if any)
+    if not any(hint in text for hint, _ in CONFERENCE_PROVIDERS.values()):
+        return None
+    m = _conference_regex().search(text)
+    return m.group(0) if m else None
+
+
+def guess_conference_location(event, revision=None):
+    # NOTE revision identifies a specific version of the event (eg: its ID
+    # and change key), if set the result is memoized.
+    if revision is not None:
+        url = CONFERENCE_CACHE.get(revision, False)
+        if url is not False:
+            return url
 
-def guess_conference_location(event):
     # Search in location and description
-    fields = [str(event.get("location")), str(event.get("description"))]
+    fields = [event.get("location"), event.get("description")]
 
     # Search in any extra field if any
-    if "extra" in event:
-        for val in event.get("extra").values():
-            if val:
-                # NOTE re.findall expects strings, so let's convert the values
-                # to str.
-                fields.append(str(val))
-
-    for val in [x for x in fields if x]:
-        for regex in [REGEX_ZOOM_URL, REGEX_MS_TEAMS_URL]:
-            if m := re.findall(regex, val):
-                # The first link wins
-                return m[0]
+    if event.get("extra"):
+        fields += event.get("extra").values()
+
+    url = None
+    for val in fields:
+        if not val:
+            continue
+        # NOTE Values might not be strings (eg: Google's conference data)
+        if url := find_conference_url(
+            val if isinstance(val, str) else str(val)
+        ):
+            # The first link wins
+            break
+
+    if revision is not None:
+        CONFERENCE_CACHE.set(revision, url)
+    return url
+
+
+def as_datetime(value):
+    # Convert a date, datetime or date string to a tz-aware datetime
+    if isinstance(value, str):
+        value = dparse(value)
+    elif not isinstance(value, datetime.datetime):
+        value = datetime.datetime.combine(value, datetime.time.min)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=LOCAL_TZ)
+    return value
+
+
+# Texts at least this long are kept compressed in memory (and in the cache)
+COMPRESS_MIN_SIZE = int(os.environ.get("EVENT_COMPRESS_MIN_SIZE", 512))
+
+
+class CompressedText:
+    """zlib-compressed text, only decompressed when it's needed"""
+
+    __slots__ = ("data",)
+
+    def __init__(self, text):
+        self.data = zlib.compress(text.encode("utf-8"))
+
+    def __str__(self):
+        return zlib.decompress(self.data).decode("utf-8")
+
+
+def compact_text(value):
+    if isinstance(value, str) and len(value) >= COMPRESS_MIN_SIZE:
+        return CompressedText(value)
+    return value
+
+
+def _intern(value):
+    # The same calendar names, statuses, email addresses etc. are repeated
+    # over and over, only keep one copy of each
+    return sys.intern(value) if type(value) is str else value
+
+
+@dataclasses.dataclass(slots=True)
+class Attendee:
+    name: Optional[str] = None
+    email: Optional[str] = None
+    optional: bool = False
+    response: Optional[str] = None
+
+    def __post_init__(self):
+        self.name = _intern(self.name)
+        self.email = _intern(self.email)
+        self.response = _intern(self.response)
+
+
+def to_attendee(value):
+    if isinstance(value, Attendee):
+        return value
+    if isinstance(value, Mapping):
+        return Attendee(
+            **{k: v for k, v in value.items() if k in ATTENDEE_FIELDS}
+        )
+    # Older caches hold the attendee objects of the backends (eg: gcsa's)
+    return Attendee(
+        name=getattr(value, "display_name", None),
+        email=getattr(value, "email", None),
+        optional=bool(getattr(value, "optional", False)),
+        response=getattr(value, "response_status", None),
+    )
+
+
+@dataclasses.dataclass(slots=True, eq=False)
+class Event:
+    """
+    Canonical event record: start and end are tz-aware datetimes, attendees
+    and categories are tuples and the long texts are compressed.
+
+    Also supports dict-style access (event["start"], event.get("uid")...),
+    in which case the texts get decompressed.
+    """
+
+    uid: Optional[str] = None
+    backend: Optional[str] = None
+    calendar: Optional[str] = None
+    organizer: Optional[str] = None
+    attendees: tuple = ()
+    summary: Optional[str] = None
+    description: Optional[str] = None
+    body: Optional[str] = None
+    location: Optional[str] = None
+    start: Optional[datetime.datetime] = None
+    end: Optional[datetime.datetime] = None
+    whole_day: bool = False
+    is_recurring: bool = False
+    status: Optional[str] = None
+    categories: Optional[tuple] = None
+    extra: Optional[dict] = None
+    conference_url: Optional[str] = None
+
+    def __post_init__(self):
+        self.backend = _intern(self.backend)
+        self.calendar = _intern(self.calendar)
+        self.organizer = _intern(self.organizer)
+        self.status = _intern(self.status)
+        self.attendees = tuple(to_attendee(x) for x in self.attendees or ())
+        if self.categories is not None:
+            self.categories = tuple(_intern(x) for x in self.categories)
+        self.description = compact_text(self.description)
+        self.body = compact_text(self.body)
+        if self.start is not None:
+            self.start = as_datetime(self.start)
+        if self.end is not None:
+            self.end = as_datetime(self.end)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**{k: v for k, v in data.items() if k in EVENT_FIELDS})
+
+    def __contains__(self, key):
+        return key in EVENT_FIELDS
+
+    def __getitem__(self, key):
+        if key not in EVENT_FIELDS:
+            raise KeyError(key)
+        value = getattr(self, key)
+        return str(value) if isinstance(value, CompressedText) else value
+
+    def __setitem__(self, key, value):
+        if key not in EVENT_FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        return self[key] if key in EVENT_FIELDS else default
+
+
+ATTENDEE_FIELDS = frozenset(x.name for x in dataclasses.fields(Attendee))
+EVENT_FIELDS = frozenset(x.name for x in dataclasses.fields(Event))
+
+
+def to_event(value):
+    # Events restored from older caches are plain dicts
+    return value if isinstance(value, Event) else Event.from_dict(value)
+
+
+def project_event(event, profile=None):
+    # Event record with only the fields of the given (or configured) field
+    # profile, the other ones are left empty
+    fields = FIELD_PROFILES.get(profile or FIELD_PROFILE)
+    if fields is not None:
+        event = {k: event.get(k) for k in fields}
+    return to_event(event)
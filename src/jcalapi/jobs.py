@@ -0,0 +1,85 @@
+# coding: utf-8
+
+import asyncio
+import datetime
+import logging
+import os
+import uuid
+
+from jcalapi.utils import LRUCache
+
+LOGGER = logging.getLogger(__name__)
+
+# In-flight jobs: {key: job}
+RUNNING = {}
+# All the jobs, by ID. Finished jobs are kept around for JOBS_TTL seconds.
+JOBS = LRUCache(
+    maxsize=int(os.environ.get("JOBS_HISTORY", 128)),
+    ttl=int(os.environ.get("JOBS_TTL", 60 * 60)),
+)
+
+
+def job_info(job):
+    return {k: v for k, v in job.items() if k != "task"}
+
+
+def _finish(key, job, task):
+    RUNNING.pop(key, None)
+    job["finished"] = datetime.datetime.now()
+    if task.cancelled():
+        job["status"] = "cancelled"
+    elif task.exception() is not None:
+        job["status"] = "failed"
+        job["error"] = str(task.exception()) or repr(task.exception())
+    else:
+        job["status"] = "done"
+        job["result"] = task.result()
+
+
+def start_job(key, name, func, timeout=None):
+    """
+    Run func() (a coroutine function) as a job, unless a job with the same
+    key is already running in which case that one is returned.
+    The job gets cancelled (and fails) if it runs for more than timeout
+    seconds.
+    """
+    job = RUNNING.get(key)
+    if job is not None:
+        LOGGER.info(f"Joining running job {job['id']} ({name})")
+        return job
+
+    job = {
+        "id": uuid.uuid4().hex,
+        "name": name,
+        "status": "running",
+        "started": datetime.datetime.now(),
+    }
+    task = asyncio.create_task(
+        asyncio.wait_for(func(), timeout) if timeout is not None else func()
+    )
+    job["task"] = task
+    task.add_done_callback(lambda t: _finish(key, job, t))
+    RUNNING[key] = job
+    JOBS.set(job["id"], job)
+    return job
+
+
+async def single_flight(key, name, func, wait=True, timeout=None):
+    """
+    Concurrent calls with the same key share a single run of func().
+    Returns its result, or the job info right away if wait is False.
+    """
+    job = start_job(key, name, func, timeout=timeout)
+    if not wait:
+        return job_info(job)
+    # Don't cancel the shared run if this caller gets cancelled
+    return await asyncio.shield(job["task"])
+
+
+def get_job(job_id):
+    job = JOBS.get(job_id)
+    return job_info(job) if job is not None else None
+
+
+def running_jobs():
+    return [job_info(x) for x in RUNNING.values()]
@@ -0,0 +1,57 @@
+# coding: utf-8
+
+import logging
+import os
+import socket
+import uuid
+
+LOGGER = logging.getLogger(__name__)
+
+# When running multiple workers, a single one (the leader) refreshes the
+# backends. The others (followers) pick up its data from the shared cache.
+LEADER_ELECTION = os.environ.get("LEADER_ELECTION", "true").lower() in [
+    "true",
+    "yes",
+    "1",
+]
+LEADER_KEY = "leader"
+# Lease duration (in seconds), if the leader dies another worker takes over
+# once it expired
+LEADER_LEASE = int(os.environ.get("LEADER_LEASE", 60))
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+_STATE = {"leader": not LEADER_ELECTION}
+
+
+def is_leader():
+    return _STATE["leader"]
+
+
+def renew_lease(cache):
+    """Acquire or renew the leader lease, return whether we are the leader"""
+    if not LEADER_ELECTION:
+        return True
+
+    with cache.transact():
+        holder = cache.get(LEADER_KEY)
+        leader = holder is None or holder == WORKER_ID
+        if leader:
+            cache.set(LEADER_KEY, WORKER_ID, expire=LEADER_LEASE)
+
+    if leader != _STATE["leader"]:
+        LOGGER.info(
+            f"Worker {WORKER_ID} is now "
+            f"{'the leader' if leader else f'following {holder}'}"
+        )
+    _STATE["leader"] = leader
+    return leader
+
+
+def release_lease(cache):
+    if not LEADER_ELECTION or not _STATE["leader"]:
+        return
+    with cache.transact():
+        if cache.get(LEADER_KEY) == WORKER_ID:
+            cache.delete(LEADER_KEY)
+    _STATE["leader"] = False
+    LOGGER.info(f"Worker {WORKER_ID} released the leader lease")
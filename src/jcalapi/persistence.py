@@ -0,0 +1,173 @@
+# coding: utf-8
+
+import hashlib
+import logging
+import pickle
+
+from jcalapi.events import Event
+
+LOGGER = logging.getLogger(__name__)
+
+# The events of each backend are stored as one record per event, along with
+# an index: {"hashes": {record key: content hash}, "order": [record key]}
+INDEX_SUFFIX = "-index"
+# Records loaded or saved by this worker: {backend: {key: (hash, event)}}
+RECORDS = {}
+# Hash of the sync states saved by this worker: {key: hash}
+STATE_HASHES = {}
+
+
+def record_key(backend, event):
+    # The occurrences of a recurring event share its UID, their start
+    # (ie: recurrence ID) tells them apart. The same event also shows up in
+    # several calendars (shared inboxes etc).
+    return (
+        f"{backend}-event-{event.calendar}-{event.uid}-"
+        f"{event.start.isoformat()}"
+    )
+
+
+def _digest(event):
+    return hashlib.blake2b(
+        pickle.dumps(event, protocol=pickle.HIGHEST_PROTOCOL), digest_size=16
+    ).digest()
+
+
+def save_events(cache, backend, events, expire=None):
+    """
+    Store the events of a backend. Only the new, changed and deleted records
+    get written, in a single transaction.
+    The index expires after expire seconds, the records are tagged with the
+    backend name so that the orphans can be evicted.
+    """
+    records = {}
+    order = []
+    duplicates = {}
+    for ev in events:
+        key = record_key(backend, ev)
+        if key in records:
+            # Any remaining duplicate is told apart by its position
+            duplicates[key] = duplicates.get(key, 0) + 1
+            key = f"{key}-{duplicates[key]}"
+        records[key] = (_digest(ev), ev)
+        order.append(key)
+
+    with cache.transact():
+        index = cache.get(f"{backend}{INDEX_SUFFIX}")
+        if index is None:
+            # Any record left is an orphan
+            cache.evict(backend)
+            cache.delete(backend)
+        hashes = index["hashes"] if index else {}
+        changed = [k for k, (h, _) in records.items() if hashes.get(k) != h]
+        deleted = [k for k in hashes if k not in records]
+        for key in changed:
+            cache.set(key, records[key][1], tag=backend)
+        for key in deleted:
+            cache.delete(key)
+        cache.set(
+            f"{backend}{INDEX_SUFFIX}",
+            {
+                "hashes": {k: h for k, (h, _) in records.items()},
+                "order": order,
+            },
+            expire=expire,
+        )
+
+    RECORDS[backend] = records
+    LOGGER.info(
+        f"Saved {backend} events: {len(changed)} changed, "
+        f"{len(deleted)} deleted, {len(records)} total"
+    )
+    return len(changed) + len(deleted)
+
+
+def load_events(cache, backend):
+    """
+    Events of a backend, None if there are none (or if they are incomplete).
+    Only the records that changed since the last load get read.
+    """
+    known = RECORDS.get(backend, {})
+    records = {}
+    with cache.transact():
+        index = cache.get(f"{backend}{INDEX_SUFFIX}")
+        if index is None:
+            # Stored by an older version, as a single list
+            return cache.get(backend)
+        for key, digest in index["hashes"].items():
+            record = known.get(key)
+            if record is None or record[0] != digest:
+                event = cache.get(key)
+                if event is None:
+                    LOGGER.warning(f"Missing {backend} event record: {key}")
+                    return None
+                record = (digest, event)
+            records[key] = record
+
+    RECORDS[backend] = records
+    return [records[k][1] for k in index["order"]]
+
+
+class RecordRef:
+    # Stands for an event record in a stored sync state
+    __slots__ = ("key",)
+
+    def __init__(self, key):
+        self.key = key
+
+
+def _pack(value, keys):
+    if isinstance(value, Event):
+        key = keys.get(id(value))
+        return RecordRef(key) if key is not None else value
+    if isinstance(value, dict):
+        return {k: _pack(v, keys) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_pack(x, keys) for x in value)
+    return value
+
+
+def _unpack(value, records, cache):
+    if isinstance(value, RecordRef):
+        record = records.get(value.key)
+        event = record[1] if record is not None else cache.get(value.key)
+        if event is None:
+            raise KeyError(value.key)
+        return event
+    if isinstance(value, dict):
+        return {k: _unpack(v, records, cache) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_unpack(x, records, cache) for x in value)
+    return value
+
+
+def save_state(cache, key, backend, state):
+    """
+    Store the sync state of a backend. It usually holds the (converted)
+    events as well: these are stored as references to the event records of
+    the backend (see save_events), which must be saved first.
+    The state only gets written when it changed.
+    """
+    keys = {id(ev): k for k, (_, ev) in RECORDS.get(backend, {}).items()}
+    packed = _pack(state, keys)
+    digest = _digest(packed)
+    if STATE_HASHES.get(key) == digest:
+        return False
+    cache.set(key, packed)
+    STATE_HASHES[key] = digest
+    return True
+
+
+def load_state(cache, key, backend, default=None):
+    # Sync state of a backend, default if there is none (or if some of the
+    # event records it refers to are gone)
+    packed = cache.get(key)
+    if packed is None:
+        return default
+    try:
+        state = _unpack(packed, RECORDS.get(backend, {}), cache)
+    except KeyError as exc:
+        LOGGER.warning(f"Discarding {backend} sync state, missing {exc}")
+        return default
+    STATE_HASHES[key] = _digest(packed)
+    return state
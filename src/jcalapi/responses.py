@@ -0,0 +1,66 @@
+# coding: utf-8
+
+import datetime
+import hashlib
+import os
+
+import orjson
+from fastapi import Request, Response
+
+from jcalapi.events import CompressedText
+from jcalapi.utils import LRUCache
+
+# Latest encoded response of each endpoint (and parameters):
+# {key: (version, body, etag)}
+RESPONSE_CACHE = LRUCache(
+    maxsize=int(os.environ.get("RESPONSE_CACHE_SIZE", 256))
+)
+
+
+def _json_default(obj):
+    # NOTE orjson serializes the events (dataclasses) directly
+    if isinstance(obj, CompressedText):
+        return str(obj)
+    if isinstance(obj, (datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, (set, frozenset, tuple)):
+        return list(obj)
+    if hasattr(obj, "__dict__"):
+        # eg: gcsa objects
+        return vars(obj)
+    return str(obj)
+
+
+def json_encode(data):
+    return orjson.dumps(data, default=_json_default)
+
+
+def _etag_matches(request, etag):
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = [x.strip().removeprefix("W/") for x in header.split(",")]
+    return etag in tags or "*" in tags
+
+
+def cached_json_response(request: Request, key, version, data):
+    """
+    JSON response, encoded once per key (eg: the endpoint and its
+    parameters) and version of the data (eg: the data generation). Only
+    the latest version is kept.
+    Conditional requests (If-None-Match) get a 304 if the data didn't change.
+    """
+    entry = RESPONSE_CACHE.get(key)
+    if entry is None or entry[0] != version:
+        body = data() if callable(data) else data
+        body = json_encode(body)
+        etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+        entry = (version, body, etag)
+        RESPONSE_CACHE.set(key, entry)
+
+    _, body, etag = entry
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(
+        content=body, media_type="application/json", headers={"ETag": etag}
+    )
@@ -0,0 +1,127 @@
+# coding: utf-8
+
+import asyncio
+import datetime
+import logging
+import os
+import random
+import time
+
+from jcalapi.events import LOCAL_TZ
+
+LOGGER = logging.getLogger(__name__)
+
+# Base refresh interval (in seconds), can be overridden per backend with
+# <BACKEND>_REFRESH_INTERVAL (eg: CONFLUENCE_REFRESH_INTERVAL=1800)
+REFRESH_INTERVAL = int(os.environ.get("REFRESH_INTERVAL", 60 * 5))
+# Upper bound of the exponential backoff after failed refreshes
+REFRESH_MAX_BACKOFF = int(os.environ.get("REFRESH_MAX_BACKOFF", 60 * 60))
+# Refresh more often when a meeting starts within the lead time
+REFRESH_MEETING_LEAD_TIME = int(
+    os.environ.get("REFRESH_MEETING_LEAD_TIME", 60 * 15)
+)
+REFRESH_MEETING_INTERVAL = int(os.environ.get("REFRESH_MEETING_INTERVAL", 60))
+# ... and less often outside of the working hours (and on weekends)
+REFRESH_WORK_HOURS = os.environ.get("REFRESH_WORK_HOURS", "7-19")
+REFRESH_OFF_HOURS_FACTOR = float(os.environ.get("REFRESH_OFF_HOURS_FACTOR", 4))
+# Random +/- fraction applied to the intervals, so that the refreshes of
+# the different backends (and retries) don't happen in lockstep
+REFRESH_JITTER = float(os.environ.get("REFRESH_JITTER", 0.1))
+
+
+def refresh_interval(backend):
+    return int(
+        os.environ.get(f"{backend.upper()}_REFRESH_INTERVAL", REFRESH_INTERVAL)
+    )
+
+
+def is_off_hours(now):
+    work_start, work_end = (int(x) for x in REFRESH_WORK_HOURS.split("-"))
+    return now.weekday() >= 5 or not work_start <= now.hour < work_end
+
+
+def next_delay(backend, failures=0, next_start=None, now=None):
+    """
+    Delay (in seconds) until the next refresh of a backend:
+    - exponential backoff after failures
+    - REFRESH_MEETING_INTERVAL if a meeting starts soon (next_start)
+    - longer outside of the working hours
+    """
+    now = now or datetime.datetime.now(tz=LOCAL_TZ)
+    delay = refresh_interval(backend)
+    if failures:
+        delay = min(delay * 2**failures, REFRESH_MAX_BACKOFF)
+    elif (
+        next_start is not None
+        and (next_start - now).total_seconds() <= REFRESH_MEETING_LEAD_TIME
+    ):
+        delay = min(delay, REFRESH_MEETING_INTERVAL)
+    elif is_off_hours(now.astimezone(LOCAL_TZ)):
+        delay *= REFRESH_OFF_HOURS_FACTOR
+    return delay * random.uniform(1 - REFRESH_JITTER, 1 + REFRESH_JITTER)
+
+
+class Scheduler:
+    """
+    Refreshes each backend on its own schedule (see next_delay).
+
+    - refresh: async function(backend) returning the result of the refresh
+      ({"events": ..., "error": ...}), None if it was skipped
+    - next_start: function(backend) returning the start of its next event
+    """
+
+    def __init__(self, backends, refresh, next_start):
+        self.refresh = refresh
+        self.next_start = next_start
+        self.failures = {b: 0 for b in backends}
+        self.due = {}
+        self.tasks = {}
+        for backend in backends:
+            self.schedule(backend)
+
+    def schedule(self, backend):
+        delay = next_delay(
+            backend,
+            failures=self.failures[backend],
+            next_start=self.next_start(backend),
+        )
+        self.due[backend] = time.monotonic() + delay
+        LOGGER.info(f"Next refresh of {backend} in {round(delay)}s")
+
+    async def _run(self, backend):
+        try:
+            res = await self.refresh(backend)
+        except Exception as exc:
+            LOGGER.exception(f"Scheduled refresh of {backend} failed: {exc}")
+            res = {"error": str(exc)}
+        if res is not None and res.get("error"):
+            self.failures[backend] += 1
+        elif res is not None:
+            self.failures[backend] = 0
+        self.schedule(backend)
+
+    async def run(self):
+        try:
+            while True:
+                now = time.monotonic()
+                for backend, due in self.due.items():
+                    if due > now:
+                        continue
+                    if backend in self.tasks:
+                        # Skip this tick, the task reschedules it once done
+                        LOGGER.info(f"Refresh of {backend} still in progress")
+                        self.schedule(backend)
+                        continue
+                    task = asyncio.create_task(self._run(backend))
+                    self.tasks[backend] = task
+                    task.add_done_callback(
+                        lambda _, b=backend: self.tasks.pop(b, None)
+                    )
+                wakeup = min(
+                    [d for b, d in self.due.items() if b not in self.tasks],
+                    default=now + 1,
+                )
+                await asyncio.sleep(min(max(wakeup - now, 1), 60))
+        finally:
+            for task in list(self.tasks.values()):
+                task.cancel()
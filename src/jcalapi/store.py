@@ -0,0 +1,171 @@
+# coding: utf-8
+
+import bisect
+import logging
+
+from jcalapi.events import LOCAL_TZ, to_event
+
+LOGGER = logging.getLogger(__name__)
+
+
+class _BackendIndex:
+    # Index of the events of a single backend, built once at ingest time:
+    # - days: {date: [event, ...]} (events are bucketed under both their
+    #   local start and end date)
+    # - starts/spans: events sorted by start (epoch seconds)
+    # - max_ends: interval tree over the spans, for overlap queries. The
+    #   spans form an implicit binary search tree (the node of the range
+    #   [lo, hi) is its middle), max_ends[i] is the latest end of the
+    #   subtree of node i.
+    __slots__ = ("events", "days", "starts", "spans", "max_ends")
+
+    def __init__(self, events):
+        self.events = events
+        self.days = {}
+        spans = []
+
+        for ev in events:
+            ev_start = ev.start
+            ev_end = ev.end
+            days = {
+                ev_start.astimezone(LOCAL_TZ).date(),
+                ev_end.astimezone(LOCAL_TZ).date(),
+            }
+            for day in days:
+                self.days.setdefault(day, []).append(ev)
+
+            spans.append((ev_start.timestamp(), ev_end.timestamp(), ev))
+
+        spans.sort(key=lambda x: x[0])
+        self.spans = spans
+        self.starts = [x[0] for x in spans]
+        self.max_ends = [0.0] * len(spans)
+        self._build(0, len(spans))
+
+    def _build(self, lo, hi):
+        if lo >= hi:
+            return float("-inf")
+        mid = (lo + hi) // 2
+        max_end = max(
+            self.spans[mid][1], self._build(lo, mid), self._build(mid + 1, hi)
+        )
+        self.max_ends[mid] = max_end
+        return max_end
+
+    def overlapping(self, start_ts, end_ts):
+        # Events whose [start, end] interval intersects (start_ts, end_ts),
+        # sorted by start. Only the events that start before end_ts are
+        # candidates, and the subtrees that all end before start_ts are
+        # skipped: O(log n + k) (k being the number of matches).
+        limit = bisect.bisect_left(self.starts, end_ts)
+        found = []
+        stack = [(0, len(self.spans))]
+        while stack:
+            lo, hi = stack.pop()
+            if lo >= hi or lo >= limit:
+                continue
+            mid = (lo + hi) // 2
+            if self.max_ends[mid] <= start_ts:
+                continue
+            if mid < limit and self.spans[mid][1] > start_ts:
+                found.append(mid)
+            stack.append((lo, mid))
+            stack.append((mid + 1, hi))
+        found.sort()
+        return [self.spans[i][2] for i in found]
+
+
+class EventStore:
+    """
+    In-memory event storage, indexed per backend at ingest time.
+
+    Can be used like a dict of {backend: [event, ...]}.
+    The generation gets incremented every time the events change.
+    """
+
+    def __init__(self, backends):
+        self._index = {b: _BackendIndex([]) for b in backends}
+        self.generation = 0
+
+    def __getitem__(self, backend):
+        return self._index[backend].events
+
+    def __setitem__(self, backend, events):
+        self._index[backend] = _BackendIndex([to_event(x) for x in events])
+        self.generation += 1
+
+    def __contains__(self, backend):
+        return backend in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def keys(self):
+        return self._index.keys()
+
+    def values(self):
+        return [x.events for x in self._index.values()]
+
+    def items(self):
+        return [(k, v.events) for k, v in self._index.items()]
+
+    def get(self, backend, default=None):
+        index = self._index.get(backend)
+        return index.events if index is not None else default
+
+    def evict(self, before):
+        """Drop the events that ended before the given (tz-aware) datetime"""
+        for backend, index in list(self._index.items()):
+            events = [x for x in index.events if x.end >= before]
+            if len(events) < len(index.events):
+                LOGGER.info(
+                    f"Evicted {len(index.events) - len(events)} past "
+                    f"{backend} events"
+                )
+                self[backend] = events
+
+    def next_start(self, backend, moment):
+        """Start of the next event of a backend (after the given datetime)"""
+        index = self._index[backend]
+        i = bisect.bisect_left(index.starts, moment.timestamp())
+        return index.spans[i][2].start if i < len(index.spans) else None
+
+    def _filter(self, events, ignore_calendars=None):
+        # Skip ignored calendars and duplicate events (by UID)
+        seen = set()
+        res = []
+        for ev in events:
+            if ignore_calendars and ev.calendar in ignore_calendars:
+                continue
+            uid = ev.uid
+            if uid in seen:
+                LOGGER.warning(f"Duplicate event skipped: {ev}")
+                continue
+            seen.add(uid)
+            res.append(ev)
+        return res
+
+    def merged(self, ignore_calendars=None):
+        res = []
+        for index in self._index.values():
+            res += (
+                [x for x in index.events if x.calendar not in ignore_calendars]
+                if ignore_calendars
+                else index.events
+            )
+        return res
+
+    def on_date(self, date, ignore_calendars=None):
+        """Events starting or ending on the given date"""
+        candidates = []
+        for index in self._index.values():
+            candidates += index.days.get(date, [])
+        return self._filter(candidates, ignore_calendars)
+
+    def at(self, moment, ignore_calendars=None):
+        """Events happening at the given (tz-aware) datetime"""
+        ts = moment.timestamp()
+        candidates = []
+        for index in self._index.values():
+            candidates += index.overlapping(ts, ts)
+        return self._filter(candidates, ignore_calendars)
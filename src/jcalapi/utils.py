@@ -1,4 +1,7 @@
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from html.parser import HTMLParser
 
 
 def next_monday():
@@ -12,3 +15,81 @@ def next_monday():
         days_ahead += 7
     next_monday = today + timedelta(days=days_ahead)
     return next_monday
+
+
+class LRUCache:
+    """Simple in-memory LRU cache, entries optionally expire after ttl secs"""
+
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # {key: (value, expiry)}
+        self._data = OrderedDict()
+
+    def __contains__(self, key):
+        return self._lookup(key) is not None
+
+    def __len__(self):
+        return len(self._data)
+
+    def _lookup(self, key):
+        entry = self._data.get(key)
+        if entry is not None and entry[1] is not None:
+            if entry[1] <= time.monotonic():
+                del self._data[key]
+                return None
+        return entry
+
+    def get(self, key, default=None):
+        entry = self._lookup(key)
+        if entry is None:
+            return default
+        self._data.move_to_end(key)
+        return entry[0]
+
+    def set(self, key, value):
+        expiry = time.monotonic() + self.ttl if self.ttl else None
+        self._data[key] = (value, expiry)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+
+class _HTMLTextParser(HTMLParser):
+    # Collects the text and the link targets of an HTML document in a single
+    # pass. Like BeautifulSoup's get_text(), the content of scripts, styles
+    # and templates is ignored.
+    SKIP_TAGS = {"script", "style", "template"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.text = []
+        self.links = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self._skip += 1
+        elif tag == "a":
+            href = dict(attrs).get("href")
+            if href:
+                self.links.append(href)
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS and self._skip:
+            self._skip -= 1
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.text.append(data)
+
+
+def html_to_text(html):
+    """Returns the text and the list of links of an HTML document"""
+    parser = _HTMLTextParser()
+    parser.feed(html)
+    parser.close()
+    return "".join(parser.text), parser.links